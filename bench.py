@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# QR code inspector: benchmark
+#
+# 使い方: python bench.py [-v 1-40] [-e LMQH] [-m 0-7] [--errors N]
+#                         [--erasures N] [-o result.json]
+#                         [--baseline base.json] [--threshold 0.2]
+#   指定した全ての (version, ECL, mask) のシンボルを生成して,
+#   工程ごとの時間・スループット・メモリ使用量の最大値を測る
+#   --baselineを指定すると工程ごとに比較して, threshold以上遅くなっていれば
+#   終了コード1で終わる
+
+import argparse
+import gc
+import json
+import random
+import resource
+import sys
+import time
+
+import qr
+
+ECL_VALUES = dict((n, e) for (e, n) in qr.ECL_NAMES.items())
+
+### Symbol Generator ###
+
+def encode_data(data, version, ecl):
+    # バイトモードの1セグメント + 終端 + 埋め草 のデータ符号語
+    ndata = qr.block_layout(version, ecl)[4]
+    bits = "{:04b}".format(qr.MODE_BYTE)
+    bits += "{:0{}b}".format(len(data), qr.ccilen(version, qr.MODE_BYTE))
+    bits += "".join([qr.byte_bits_table[ord(c)] for c in data])
+    assert len(bits) <= ndata * 8, "data too long"
+    bits += "0" * min(4, ndata * 8 - len(bits))
+    bits += "0" * (-len(bits) % 8)
+    codewords = qr.bits_to_bytes(bits)
+    pads = [0xec, 0x11]
+    while len(codewords) < ndata:
+        codewords.append(pads[(len(codewords) - len(bits) // 8) % 2])
+    return codewords
+
+def encode_codewords(data, version, ecl):
+    # ブロックごとにECCを付けてinterleaveした符号語 (extract_codewordsの並び)
+    (necc, nblocks, nshort, nshortblocks, ndata) = \
+        qr.block_layout(version, ecl)
+    rs = qr.rs_codec(necc)
+    codewords = bytearray(ndata + necc * nblocks)
+    p = 0
+    for positions in qr.block_positions(version, ecl):
+        n = len(positions) - necc
+        block = rs.encode(data[p:p + n])
+        p += n
+        for (i, c) in zip(positions, block):
+            codewords[i] = c
+    return codewords
+
+def function_patterns(version):
+    # 機能パターンだけを描いたrows (データ部分は0)
+    size = version * 4 + 17
+    values = qr.function_pattern_values(version)
+    return [list(values[y * size:(y + 1) * size]) for y in range(size)]
+
+def place_format(rows, ecl, mask):
+    # extract_formatの逆
+    f = qr.gen_format(ecl, mask)
+    for fl in qr.format_coordinates(len(rows)):
+        for (i, (x, y)) in enumerate(fl):
+            rows[y][x] = (f >> (14 - i)) & 1
+
+def place_version(rows, version):
+    # extract_versionの逆
+    v = qr.gen_version(version)
+    for vl in qr.version_coordinates(len(rows)):
+        for (i, (x, y)) in enumerate(vl):
+            rows[y][x] = (v >> (17 - i)) & 1
+
+def make_symbol(version, ecl, mask, data):
+    # dataをバイトモードで符号化したシンボルのrows
+    rows = function_patterns(version)
+    place_format(rows, ecl, mask)
+    if version >= 7:
+        place_version(rows, version)
+    codewords = encode_codewords(encode_data(data, version, ecl),
+                                 version, ecl)
+    bits = "".join([qr.byte_bits_table[c] for c in codewords])
+    for (i, (x, y)) in enumerate(qr.payload_coordinates(version)):
+        b = int(bits[i]) if i < len(bits) else 0
+        rows[y][x] = b ^ qr.mask_at(mask, x, y)
+    return rows
+
+def capacity(version, ecl):
+    # バイトモードで入る最大の文字数
+    ndata = qr.block_layout(version, ecl)[4]
+    return (ndata * 8 - 4 - qr.ccilen(version, qr.MODE_BYTE)) // 8
+
+def inject_damage(rows, version, ecl, errors, erasures, rnd):
+    # 各ブロックでerrors個の符号語を誤りに, erasures個の符号語を未知にする
+    # (訂正能力 2 * errors + erasures <= ECC長 を超えないように減らす)
+    necc = qr.block_layout(version, ecl)[0]
+    erasures = min(erasures, necc)
+    errors = min(errors, (necc - erasures) // 2)
+    coords = qr.payload_coordinates(version)
+    for positions in qr.block_positions(version, ecl):
+        chosen = rnd.sample(positions, errors + erasures)
+        for (k, i) in enumerate(chosen):
+            modules = coords[8 * i:8 * i + 8]
+            if k < errors:
+                (x, y) = rnd.choice(modules)
+                rows[y][x] ^= 1
+            else:
+                for (x, y) in modules:
+                    rows[y][x] = None
+    return rows
+
+def generate(versions, ecls, masks, errors = 0, erasures = 0, seed = 0):
+    # [(version, ecl, mask, data, Symbol)]
+    rnd = random.Random(seed)
+    alphabet = "".join([chr(c) for c in range(0x20, 0x7f)])
+    cases = []
+    for version in versions:
+        for ecl in ecls:
+            for mask in masks:
+                n = capacity(version, ecl)
+                data = "".join([rnd.choice(alphabet) for i in range(n)])
+                rows = make_symbol(version, ecl, mask, data)
+                if errors or erasures:
+                    inject_damage(rows, version, ecl, errors, erasures, rnd)
+                cases.append((version, ecl, mask, data,
+                              qr.Symbol.from_rows(rows)))
+    return cases
+
+### Benchmark ###
+
+def peak_memory():
+    # プロセスの最大常駐メモリ (KB, Linuxのru_maxrss)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def prepare(cases):
+    # 各工程の入力を前もって作っておく (結果の検証もする)
+    states = []
+    for (version, ecl, mask, data, symbol) in cases:
+        state = {"version": version, "ecl": ecl, "mask": mask,
+                 "data": data, "symbol": symbol}
+        state["format"] = qr.extract_format(symbol)
+        assert qr.match_format(state["format"])[0][3] == (ecl, mask)
+        if version >= 7:
+            state["version_info"] = qr.extract_version(symbol)
+            assert qr.match_version(state["version_info"])[0][3] == version
+        state["codewords"] = qr.extract_codewords(symbol, mask)
+        (state["data_groups"], state["ecc_groups"], affected) = \
+            qr.uninterleave(state["codewords"], version, ecl)
+        state["corrected"] = qr.recover_error(state["data_groups"],
+                                              state["ecc_groups"])
+        if qr.has_numpy():
+            # decode_blocksがreedsoloと同じ訂正結果になること
+            pair = [(state["data_groups"], state["ecc_groups"])]
+            assert qr.recover_errors(pair, engine="numpy") == \
+                qr.recover_errors(pair, engine="reedsolo")
+        state["bytes"] = qr.groups_to_bytes(state["corrected"])
+        assert qr.decode(state["bytes"], version)[0] == data
+        states.append(state)
+    return states
+
+# (工程名, 対象のstateか判定する関数, 実行する関数)
+stages = [
+    ("extract_format", None,
+     lambda s: qr.extract_format(s["symbol"])),
+    ("match_format", None,
+     lambda s: qr.match_format(s["format"])),
+    ("extract_version", lambda s: s["version"] >= 7,
+     lambda s: qr.extract_version(s["symbol"])),
+    ("match_version", lambda s: s["version"] >= 7,
+     lambda s: qr.match_version(s["version_info"])),
+    ("extract_codewords", None,
+     lambda s: qr.extract_codewords(s["symbol"], s["mask"])),
+    ("uninterleave", None,
+     lambda s: qr.uninterleave(s["codewords"], s["version"], s["ecl"])),
+    ("recover_error", None,
+     lambda s: qr.recover_error(s["data_groups"], s["ecc_groups"])),
+    ("groups_to_bitstring", None,
+     lambda s: qr.groups_to_bitstring(s["corrected"])),
+    ("decode", None,
+     lambda s: qr.decode(s["bytes"], s["version"])),
+]
+
+def run_stage(func, states, repeat):
+    # repeat回繰り返した中で最も速い1周の時間
+    best = None
+    for r in range(repeat):
+        gc.collect()
+        start = time.time()
+        for s in states:
+            func(s)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(cases, repeat = 3):
+    states = prepare(cases)
+    results = {}
+    for (name, applies, func) in stages:
+        targets = [s for s in states if applies is None or applies(s)]
+        if not targets:
+            continue
+        before = peak_memory()
+        seconds = run_stage(func, targets, repeat)
+        results[name] = {
+            "calls": len(targets),
+            "seconds": seconds,
+            "per_call_us": seconds / len(targets) * 1e6,
+            "per_second": len(targets) / seconds if seconds > 0 else None,
+            "peak_rss_kb": peak_memory(),
+            "peak_rss_growth_kb": peak_memory() - before,
+        }
+    return results
+
+def compare(results, baseline, threshold):
+    # [(工程名, 比率, 遅くなったか)] (比率 = 今回 / 基準)
+    rows = []
+    for (name, applies, func) in stages:
+        if name not in results or name not in baseline:
+            continue
+        ratio = (results[name]["per_call_us"] /
+                 baseline[name]["per_call_us"])
+        rows.append((name, ratio, ratio > 1 + threshold))
+    return rows
+
+def parse_range(s, low, high):
+    # "1-40" や "1,7,40" を整数のリストに
+    values = []
+    for part in s.split(","):
+        if "-" in part:
+            (a, b) = part.split("-")
+            values += range(int(a), int(b) + 1)
+        else:
+            values.append(int(part))
+    for v in values:
+        if not low <= v <= high:
+            raise argparse.ArgumentTypeError(
+                "{} is out of range {}-{}".format(v, low, high))
+    return values
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the QR code inspector.")
+    parser.add_argument("-v", "--versions", default="1-40",
+                        type=lambda s: parse_range(s, 1, 40))
+    parser.add_argument("-e", "--ecls", default="LMQH")
+    parser.add_argument("-m", "--masks", default="0-7",
+                        type=lambda s: parse_range(s, 0, 7))
+    parser.add_argument("--errors", type=int, default=0,
+                        help="erroneous codewords per block")
+    parser.add_argument("--erasures", type=int, default=0,
+                        help="unknown codewords per block")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    ecls = [ECL_VALUES[c] for c in args.ecls.upper()]
+    cases = generate(args.versions, ecls, args.masks,
+                     args.errors, args.erasures, args.seed)
+    results = run(cases, args.repeat)
+
+    print "{:<20} {:>8} {:>12} {:>12} {:>12}".format(
+        "stage", "calls", "us/call", "calls/s", "peak KB")
+    for (name, applies, func) in stages:
+        if name in results:
+            r = results[name]
+            print "{:<20} {:>8} {:>12.1f} {:>12.1f} {:>12}".format(
+                name, r["calls"], r["per_call_us"], r["per_second"] or 0,
+                r["peak_rss_kb"])
+
+    report = {
+        "config": {
+            "versions": args.versions, "ecls": args.ecls.upper(),
+            "masks": args.masks, "errors": args.errors,
+            "erasures": args.erasures, "repeat": args.repeat,
+            "seed": args.seed, "python": sys.version.split()[0],
+        },
+        "symbols": len(cases),
+        "stages": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            sys.stderr.write("warning: baseline was run with another config\n")
+        print
+        print "{:<20} {:>10}".format("stage", "vs base")
+        for (name, ratio, regressed) in compare(results, baseline["stages"],
+                                                args.threshold):
+            mark = "  REGRESSION" if regressed else ""
+            print "{:<20} {:>9.2f}x{}".format(name, ratio, mark)
+            if regressed:
+                status = 1
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,9 +15,15 @@
 #  * 適切にオブジェクト化
 #   * 特にaffectionの部分を必要ない場合に意識しないよう
 
+import binascii
+import imp
+import string
+import time
 import reedsolo
 
-class Uncertain:
+class Uncertain(object):
+    __slots__ = ("value", "mask", "bits")
+
     def __init__(self, value, mask, bits = 8):
         self.value = value & mask
         self.mask = mask
@@ -30,19 +36,70 @@ class Uncertain:
         s += ")"
         return s
 
+# 符号語列: 値と既知ビットのマスクをそれぞれbytearrayで持つ
+# 要素を取り出すと完全に既知ならint, そうでなければUncertainになる
+class Codewords(object):
+    __slots__ = ("values", "masks")
+
+    def __init__(self, values = None, masks = None):
+        if values is None:
+            values = bytearray()
+        self.values = bytearray(values)
+        if masks is None:
+            self.masks = bytearray(b"\xff" * len(self.values))
+        else:
+            self.masks = bytearray(masks)
+            assert len(self.masks) == len(self.values)
+            for i in self.uncertain_positions():
+                self.values[i] &= self.masks[i]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Codewords(self.values[i], self.masks[i])
+        if self.masks[i] == 255:
+            return self.values[i]
+        return Uncertain(self.values[i], self.masks[i])
+
+    def __iter__(self):
+        for i in range(len(self.values)):
+            yield self[i]
+
+    def __add__(self, other):
+        other = as_codewords(other)
+        return Codewords(self.values + other.values, self.masks + other.masks)
+
+    def append(self, c):
+        (v, m) = uncertain_bits(c, 8)
+        self.values.append(v & m)
+        self.masks.append(m)
+
+    def uncertain_positions(self):
+        if self.masks.count(b"\xff") == len(self.masks):
+            return []
+        return [i for (i, m) in enumerate(self.masks) if m != 255]
+
+    def __repr__(self):
+        return "Codewords(" + repr(list(self)) + ")"
+
+def as_codewords(codewords):
+    if isinstance(codewords, Codewords):
+        return codewords
+    if isinstance(codewords, bytearray):
+        return Codewords(codewords)
+    values = bytearray()
+    masks = bytearray()
+    for c in codewords:
+        (v, m) = uncertain_bits(c, 8)
+        values.append(v & m)
+        masks.append(m)
+    return Codewords(values, masks)
+
 def merge_uncertain(a, b, l):
-    if isinstance(a, Uncertain):
-        av = a.value
-        am = a.mask
-    else:
-        av = a
-        am = (1 << l) - 1
-    if isinstance(b, Uncertain):
-        bv = b.value
-        bm = b.mask
-    else:
-        bv = b
-        bm = (1 << l) - 1
+    (av, am) = uncertain_bits(a, l)
+    (bv, bm) = uncertain_bits(b, l)
 
     mismatched = (av ^ bv) & (am & bm)
     m = (am | bm) ^ mismatched
@@ -53,106 +110,171 @@ def merge_uncertain(a, b, l):
         return Uncertain(v, m)
 
 
-def show(qr, markers = []):
-    (w, h) = (len(qr[0]), len(qr))
-    scale = 16
-    import Image
-    import ImageDraw
-    img = Image.new('RGB', (scale*(w+2), scale*(h+2)))
-    draw = ImageDraw.Draw(img)
-    draw.rectangle((0, 0, scale*(w+2), scale*(h+2)), "white")
-    for y in xrange(h):
-        for x in xrange(w):
-            if (x, y) in markers:
-                if qr[y][x]:
-                    color = "darkgreen"
-                elif qr[y][x] == 0:
-                    color = "lightgreen"
-                else:
-                    color = "green"
-            else:
-                if qr[y][x] == 1:
-                    color = "black"
-                elif qr[y][x] == 0:
-                    color = "white"
-                else:
-                    color = "gray"
-
-            draw.rectangle((scale*(x+1), scale*(y+1),
-                            scale*(x+2)-1, scale*(y+2)-1),
-                           color)
-    img.show()
+### Rendering ###
+# モジュールごとの色番号: 0 明, 1 暗, 2 未知, マーカーの付いたものは +4
+# 本来の値と異なる機能パターンは +8 (マーカーより優先)
+render_palette = [
+    (255, 255, 255), (0, 0, 0), (128, 128, 128), (0, 0, 0),
+    (144, 238, 144), (0, 100, 0), (0, 128, 0), (0, 0, 0),
+] + [(255, 160, 160), (200, 0, 0), (0, 0, 0), (0, 0, 0)] * 2
+render_value_table = string.maketrans("01", "\x00\x01")
+render_unknown_table = string.maketrans("01", "\x00\x02")
+render_damage_table = string.maketrans("01", "\x00\x08")
+
+def module_colors(qr, markers = None, damage = False):
+    # シンボル全体の色番号を1モジュール1バイトで (行ごとに上から)
+    # bitの文字列をtranslateでバイト列にして, 整数のORで重ねる
+    size = len(qr)
+    n = size * size
+    (value, known) = pack_modules(qr)
+    full = (1 << n) - 1
+    v = format(value & known, "0{}b".format(n)).translate(render_value_table)
+    u = format(~known & full, "0{}b".format(n)).translate(render_unknown_table)
+    colors = int(binascii.hexlify(v), 16) | int(binascii.hexlify(u), 16)
+    if damage:
+        (expected, fixed) = function_pattern_bitmap(get_version(qr))
+        wrong = (value ^ expected) & known & fixed
+        d = format(wrong, "0{}b".format(n)).translate(render_damage_table)
+        colors |= int(binascii.hexlify(d), 16)
+    if markers:
+        overlay = bytearray(n)
+        for (x, y) in markers:
+            overlay[y * size + x] = 4
+        colors |= int(binascii.hexlify(overlay), 16)
+    return binascii.unhexlify("{:0{}x}".format(colors, 2 * n))
+
+def render(qr, markers = None, scale = 16, damage = False):
+    # シンボルの画像 (周りに1モジュールの余白を付ける)
+    # markers: 強調表示するモジュールの座標(x, y)の集まり
+    # damage: Trueなら本来の値と異なる機能パターンのモジュールを赤くする
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    size = len(qr)
+    colors = module_colors(qr, markers, damage)
+    modules = Image.frombuffer("P", (size, size), colors, "raw", "P", 0, 1)
+    img = Image.new("P", (size + 2, size + 2), 0)
+    img.paste(modules, (1, 1))
+    img.putpalette([c for rgb in render_palette for c in rgb])
+    return img.resize(((size + 2) * scale, (size + 2) * scale),
+                      Image.NEAREST)
+
+def render_bytes(qr, markers = None, scale = 16, damage = False,
+                 format = "PNG"):
+    # renderの画像をファイルの中身のバイト列で
+    import StringIO
+    buf = StringIO.StringIO()
+    render(qr, markers, scale, damage).save(buf, format)
+    return buf.getvalue()
+
+def show(qr, markers = None, output = None, scale = 16, damage = False):
+    # output: 省略時はビューアで表示, ファイル名かファイルなら書き出す
+    img = render(qr, markers, scale, damage)
+    if output is None:
+        img.show()
+    else:
+        img.save(output, "PNG")
+    return img
+
+# version: [[(x, y) * 8], ...]
+# 符号語ごとのモジュールの座標 (MSBから, 端数のremainder bitsは含まない)
+codeword_modules_table = {}
+
+def codeword_modules(version):
+    if version not in codeword_modules_table:
+        coords = payload_coordinates(version)
+        codeword_modules_table[version] = [
+            coords[i:i + 8] for i in range(0, len(coords) - 7, 8)]
+    return codeword_modules_table[version]
+
+# version: [(符号語番号, ビット位置(MSBが0)) か None, ...]
+# 添字は y * size + x
+module_codewords_table = {}
+
+def module_codewords(version):
+    if version not in module_codewords_table:
+        size = version * 4 + 17
+        table = [None] * (size * size)
+        for (k, modules) in enumerate(codeword_modules(version)):
+            for (bit, (x, y)) in enumerate(modules):
+                table[y * size + x] = (k, bit)
+        module_codewords_table[version] = table
+    return module_codewords_table[version]
+
+def module_codeword(version, x, y):
+    # (x, y)のモジュールの (符号語番号, ビット位置), データ部分でなければNone
+    size = version * 4 + 17
+    return module_codewords(version)[y * size + x]
 
 def generate_codeword_marker_table(version):
-    table = []
-    k = 0
-    markers = []
-    for (x, y) in zigzag(version):
-        if not in_payload_area(version, x, y):
-            continue
-        k += 1
-        markers.append((x, y))
-        if k == 8:
-            table.append(markers)
-            markers = []
-            k = 0
-    return table
+    return codeword_modules(version)
 
 def markerpos(chunks, version):
     coodinates = set()
-    table = generate_codeword_marker_table(version)
+    table = codeword_modules(version)
     for c in chunks:
         coodinates.update(table[c])
     return coodinates
 
+def affection_index(affection):
+    # decodeのaffectionから {符号語番号: [文字部分列の番号, ...]}
+    index = {}
+    for (i, (s, codewords)) in enumerate(affection):
+        for c in codewords:
+            index.setdefault(c, []).append(i)
+    return index
+
+def characters_at(index, version, x, y):
+    # (x, y)のモジュールに関係する文字部分列の番号のリスト
+    # index: affection_indexの戻り値
+    position = module_codeword(version, x, y)
+    if position is None:
+        return []
+    return index.get(position[0], [])
+
 
 def load(filename):
-    qr = []
+    vs = []
+    ks = []
     with open(filename) as f:
         size = int(f.readline())
         for i in range(size):
-            l = f.readline()
-            qr.append([])
-            for j in range(size):
-                if j < len(l) and l[j] != "\n":
-                    c = l[j]
-                else:
-                    c = " "
+            l = f.readline().rstrip("\n")
+            l = l[:size] + " " * (size - len(l))
+            for c in l:
                 if c == "*":
-                    qr[i].append(1)
+                    vs.append("1")
+                    ks.append("1")
                 elif c == " ":
-                    qr[i].append(0)
+                    vs.append("0")
+                    ks.append("1")
                 else:
-                    qr[i].append(None)
-    return qr
+                    vs.append("0")
+                    ks.append("0")
+    return Symbol(size, int("".join(vs), 2), int("".join(ks), 2))
 
-def hamming_distance(a, b, l):
+def uncertain_bits(a, l):
+    # (value, mask)
     if isinstance(a, Uncertain):
-        am = a.mask
-        av = a.value
+        return (a.value, a.mask)
     else:
-        am = (1 << l) - 1
-        av = a
-    if isinstance(b, Uncertain):
-        bm = b.mask
-        bv = b.value
-    else:
-        bm = (1 << l) - 1
-        bv = b
-    x = av ^ bv
-    m = am & bm
-    d = 0
-    for i in range(l):
-        if x & 1 == 1 or m & 1 == 0:
-            d += 1
-        x >>= 1
-        m >>= 1
-    return d
+        return (a, (1 << l) - 1)
+
+def popcount(x):
+    return bin(x).count("1")
+
+def hamming_distance(a, b, l):
+    (av, am) = uncertain_bits(a, l)
+    (bv, bm) = uncertain_bits(b, l)
+    # 未知のビットは不一致として数える
+    return popcount(((av ^ bv) | ~(am & bm)) & ((1 << l) - 1))
 
 ECL_L = 1
 ECL_M = 0
 ECL_Q = 3
 ECL_H = 2
+ECL_NAMES = {ECL_L: "L", ECL_M: "M", ECL_Q: "Q", ECL_H: "H"}
 
 # (version, ecl): (EC Codewords / Block,
 #                  [(#Blocks in Group i, #Data Codewords / Group i's Block)])
@@ -339,54 +461,117 @@ def gen_format(ecl, maskp):
     f = gen_rs_format(f)
     return f ^ 0b101010000010010
 
+# size: ([(x, y), ...], [(x, y), ...])
+# Format Informationの2つの領域の座標 (MSBから)
+format_coordinates_table = {}
+
+def format_coordinates(size):
+    if size not in format_coordinates_table:
+        fl1 = [(x, 8) for x in range(6) + [7, 8]]
+        fl1 += [(8, 7)] + [(8, 5 - i) for i in range(6)]
+        fl2 = [(8, size - 1 - i) for i in range(7)]
+        fl2 += [(x, 8) for x in range(size - 8, size)]
+        format_coordinates_table[size] = (fl1, fl2)
+    return format_coordinates_table[size]
+
+def split_shifts(size, coordinates):
+    # packした値から上下の数行だけを切り出して読むためのビット位置
+    # 同じ行で右に続くモジュールはまとめて読む
+    # 戻り値: (上の行数, 下の行数,
+    #          [(0: 上 / 1: 下, 最下位のshift, 幅, mask), ...])
+    half = size / 2
+    top = max([y for (x, y) in coordinates if y < half] + [-1]) + 1
+    bottom = size - min([y for (x, y) in coordinates if y >= half] + [size])
+    runs = []
+    for (x, y) in coordinates:
+        if y < half:
+            (part, shift) = (0, (top - 1 - y) * size + size - 1 - x)
+        else:
+            (part, shift) = (1, (size - 1 - y) * size + size - 1 - x)
+        if runs and runs[-1][0] == part and runs[-1][1] == shift + 1 and \
+           (shift + 1) % size != 0:
+            runs[-1] = (part, shift, runs[-1][2] + 1)
+        else:
+            runs.append((part, shift, 1))
+    runs = [(part, shift, width, (1 << width) - 1)
+            for (part, shift, width) in runs]
+    return (top, bottom, runs)
+
+def gather_bits(n, size, split):
+    # nのsplitの位置のビットを順に並べた値
+    # (大きなnのシフトは上下の切り出しの2回だけにする)
+    (top, bottom, runs) = split
+    parts = (n >> (size * (size - top)), n & ((1 << (size * bottom)) - 1))
+    v = 0
+    for (part, shift, width, mask) in runs:
+        v = (v << width) | ((parts[part] >> shift) & mask)
+    return int(v)
+
+# size: 2つの領域を続けて読むsplit_shifts
+format_shifts_table = {}
+
+def format_shifts(size):
+    if size not in format_shifts_table:
+        (fl1, fl2) = format_coordinates(size)
+        format_shifts_table[size] = split_shifts(size, fl1 + fl2)
+    return format_shifts_table[size]
+
 def extract_format(qr):
     # msb-to-lsb
-    fl1 = []
-    fl1 += qr[8][:6] + qr[8][7:9]
-    fl1.append(qr[7][8])
-    for i in range(6):
-        fl1.append(qr[5 - i][8])
-
-    fl2 = []
-    for i in range(7):
-        fl2.append(qr[len(qr) - 1 - i][8])
-    fl2 += qr[8][-8:]
-
-    f1 = 0
-    fm1 = 0
-    for x in fl1:
-        f1 *= 2
-        fm1 *= 2
-        if x == 1: f1 += 1
-        if x is not None: fm1 += 1
-    if fm1 != (1 << 15) - 1:
-        f1 = Uncertain(f1, fm1, bits=15)
-
-    f2 = 0
-    fm2 = 0
-    for x in fl2:
-        f2 *= 2
-        fm2 *= 2
-        if x == 1: f2 += 1
-        if x is not None: fm2 += 1
-    if fm2 != (1 << 15) - 1:
-        f2 = Uncertain(f2, fm2, bits=15)
-
-    return (f1, f2)
+    size = len(qr)
+    if isinstance(qr, Symbol):
+        split = format_shifts(size)
+        fs = gather_bits(qr.value, size, split)
+        if qr.known == all_known(size):
+            fms = (1 << 30) - 1
+        else:
+            fms = gather_bits(qr.known, size, split)
+        values = [(fs >> 15, fms >> 15), (fs & 0x7fff, fms & 0x7fff)]
+    else:
+        values = []
+        for fl in format_coordinates(size):
+            f = 0
+            fm = 0
+            for (x, y) in fl:
+                c = qr[y][x]
+                f *= 2
+                fm *= 2
+                if c == 1: f += 1
+                if c is not None: fm += 1
+            values.append((f, fm))
+    full = (1 << 15) - 1
+    return tuple(f if fm == full else Uncertain(f, fm, bits=15)
+                 for (f, fm) in values)
+
+# [(format code, (ecl, mask))]
+format_table = [(gen_format(e, m), (e, m)) for e in range(4) for m in range(8)]
 
 def match_format(ftuple):
-    mergedf = merge_uncertain(ftuple[0], ftuple[1], 15)
+    full = (1 << 15) - 1
+    (v, m) = uncertain_bits(merge_uncertain(ftuple[0], ftuple[1], 15), 15)
+    (v0, m0) = uncertain_bits(ftuple[0], 15)
+    (v1, m1) = uncertain_bits(ftuple[1], 15)
+    (m, m0, m1) = (~m & full, ~m0 & full, ~m1 & full)
     formats = []
-    for e in range(4):
-        for m in range(8):
-            f = gen_format(e, m)
-            d = hamming_distance(mergedf, f, 15)
-            d0 = hamming_distance(ftuple[0], f, 15)
-            d1 = hamming_distance(ftuple[1], f, 15)
-            formats.append((d, d0, d1, (e, m)))
+    for (f, em) in format_table:
+        d = bin((v ^ f) | m).count("1")
+        d0 = bin((v0 ^ f) | m0).count("1")
+        d1 = bin((v1 ^ f) | m1).count("1")
+        formats.append((d, d0, d1, em))
     formats.sort()
     return formats
 
+def match_formats(ftuples):
+    # 同じ読み取り結果は一度だけ計算する
+    results = []
+    cache = {}
+    for ftuple in ftuples:
+        key = (uncertain_bits(ftuple[0], 15), uncertain_bits(ftuple[1], 15))
+        if key not in cache:
+            cache[key] = match_format(ftuple)
+        results.append(cache[key])
+    return results
+
 
 ### Version Information ###
 ## version が 7以上の時にのみ含まれる
@@ -401,44 +586,73 @@ def gen_golay_version(v):
 def gen_version(v):
     return gen_golay_version(v)
 
+# size: ([(x, y), ...], [(x, y), ...])
+# Version Informationの2つの領域の座標 (MSBから)
+version_coordinates_table = {}
+
+def version_coordinates(size):
+    if size not in version_coordinates_table:
+        # lsb-to-msb
+        vl1 = [(x, size - 11 + y) for x in range(6) for y in range(3)]
+        vl2 = [(size - 11 + x, y) for y in range(6) for x in range(3)]
+        vl1.reverse()
+        vl2.reverse()
+        version_coordinates_table[size] = (vl1, vl2)
+    return version_coordinates_table[size]
+
+# size: 2つの領域を続けて読むsplit_shifts
+version_shifts_table = {}
+
+def version_shifts(size):
+    if size not in version_shifts_table:
+        (vl1, vl2) = version_coordinates(size)
+        version_shifts_table[size] = split_shifts(size, vl1 + vl2)
+    return version_shifts_table[size]
+
 def extract_version(qr):
-    # msb-to-lsb
-    vl1 = []
-    for x in range(6):
-        for y in range(3):
-            vl1.append(qr[-11+y][x])
-    vl1.reverse()
-
-    vl2 = []
-    for y in range(6):
-        for x in range(3):
-            vl2.append(qr[y][-11+x])
-    vl2.reverse()
-
-    v1 = 0
-    for x in vl1:
-        v1 *= 2
-        if x == 1: v1 += 1
-
-    v2 = 0
-    for x in vl2:
-        v2 *= 2
-        if x == 1: v2 += 1
-
-    return (v1, v2)
+    # msb-to-lsb, 未知のモジュールは0として読む
+    size = len(qr)
+    if isinstance(qr, Symbol):
+        vs = gather_bits(qr.value, size, version_shifts(size))
+        return (vs >> 18, vs & 0x3ffff)
+    values = []
+    for vl in version_coordinates(size):
+        v = 0
+        for (x, y) in vl:
+            v *= 2
+            if qr[y][x] == 1: v += 1
+        values.append(v)
+    return tuple(values)
+
+# [(version code, version)]
+version_table = [(gen_version(v), v) for v in range(7, 41)]
 
 def match_version(vtuple):
-    mergedv = merge_uncertain(vtuple[0], vtuple[1], 18)
+    full = (1 << 18) - 1
+    (v, m) = uncertain_bits(merge_uncertain(vtuple[0], vtuple[1], 18), 18)
+    (v0, m0) = uncertain_bits(vtuple[0], 18)
+    (v1, m1) = uncertain_bits(vtuple[1], 18)
+    (m, m0, m1) = (~m & full, ~m0 & full, ~m1 & full)
     versions = []
-    for version in range(7, 41):
-        v = gen_version(version)
-        d = hamming_distance(mergedv, v, 18)
-        d0 = hamming_distance(vtuple[0], v, 18)
-        d1 = hamming_distance(vtuple[1], v, 18)
+    for (c, version) in version_table:
+        d = bin((v ^ c) | m).count("1")
+        d0 = bin((v0 ^ c) | m0).count("1")
+        d1 = bin((v1 ^ c) | m1).count("1")
         versions.append((d, d0, d1, version))
     versions.sort()
     return versions
 
+def match_versions(vtuples):
+    # 同じ読み取り結果は一度だけ計算する
+    results = []
+    cache = {}
+    for vtuple in vtuples:
+        key = (uncertain_bits(vtuple[0], 18), uncertain_bits(vtuple[1], 18))
+        if key not in cache:
+            cache[key] = match_version(vtuple)
+        results.append(cache[key])
+    return results
+
 ### Payload ###
 alignment_pattern_locations_table = [
     None, 
@@ -483,50 +697,166 @@ alignment_pattern_locations_table = [
     [6, 26, 54, 82, 110, 138, 166],
     [6, 30, 58, 86, 114, 142, 170],
 ]
-alignment_pattern_modules = {}
-
-def in_payload_area(version, x, y):
-    if version in alignment_pattern_modules:
-        excludes = alignment_pattern_modules[version]
-    else:
-        apl = alignment_pattern_locations_table[version]
-        excludes = set()
-        for ay in apl:
-            for ax in apl:
-                if ax == apl[0] and ay == apl[0]:
-                    continue
-                if ax == apl[0] and ay == apl[-1]:
-                    continue
-                if ax == apl[-1] and ay == apl[0]:
-                    continue
-                for by in [-2, -1, 0, 1, 2]:
-                    for bx in [-2, -1, 0, 1, 2]:
-                        excludes.add((ax + bx, ay + by))
-        alignment_pattern_modules[version] = excludes
-
+### Module Classes ###
+# モジュールの種類 (module_classesの値)
+MODULE_DATA      = 0
+MODULE_FINDER    = 1
+MODULE_SEPARATOR = 2
+MODULE_TIMING    = 3
+MODULE_ALIGNMENT = 4
+MODULE_FORMAT    = 5
+MODULE_VERSION   = 6
+MODULE_DARK      = 7
+
+MODULE_CLASS_NAMES = ["data", "finder", "separator", "timing", "alignment",
+                      "format", "version", "dark"]
+
+# 値が決まっている機能パターン (Format/Version Informationは除く)
+FIXED_MODULE_CLASSES = [MODULE_FINDER, MODULE_SEPARATOR, MODULE_TIMING,
+                        MODULE_ALIGNMENT, MODULE_DARK]
+
+# version: (種類のbytearray, 機能パターンの値のbytearray)
+# 添字は y * size + x, 値はFormat/Version Informationとデータ部分では0
+module_classes_table = {}
+
+def build_module_classes(version):
     size = version * 4 + 17
+    classes = bytearray(size * size)
+    values = bytearray(size * size)
+
+    def put(x, y, c, v = 0):
+        classes[y * size + x] = c
+        values[y * size + x] = v
+
+    # Position + Separator
+    for (ox, oy) in [(0, 0), (size - 7, 0), (0, size - 7)]:
+        for y in range(-1, 8):
+            for x in range(-1, 8):
+                if not (0 <= ox + x < size and 0 <= oy + y < size):
+                    continue
+                ring = max(abs(x - 3), abs(y - 3))
+                if ring == 4:
+                    put(ox + x, oy + y, MODULE_SEPARATOR)
+                else:
+                    put(ox + x, oy + y, MODULE_FINDER, int(ring != 2))
     # Timing
-    if x == 6 or y == 6:
-        return False
-    # 左上Position + Format
-    if x <= 8 and y <= 8:
-        return False
-    # 左下Position + Format
-    if x <= 8 and size - 8 <= y:
-        return False
-    # 右上Position + Format
-    if y <= 8 and size - 8 <= x:
-        return False
-    # Alignment
-    if (x, y) in excludes:
-        return False
+    for i in range(8, size - 8):
+        put(i, 6, MODULE_TIMING, 1 - i % 2)
+        put(6, i, MODULE_TIMING, 1 - i % 2)
+    # Format
+    for i in range(9):
+        if i != 6:
+            put(i, 8, MODULE_FORMAT)
+            put(8, i, MODULE_FORMAT)
+    for i in range(8):
+        put(size - 1 - i, 8, MODULE_FORMAT)
+        put(8, size - 1 - i, MODULE_FORMAT)
+    put(8, size - 8, MODULE_DARK, 1)
+    # Alignment (タイミングパターンと重なる所は値が同じ)
+    apl = alignment_pattern_locations_table[version]
+    for ay in apl:
+        for ax in apl:
+            if (ax, ay) in [(apl[0], apl[0]), (apl[0], apl[-1]),
+                            (apl[-1], apl[0])]:
+                continue
+            for by in [-2, -1, 0, 1, 2]:
+                for bx in [-2, -1, 0, 1, 2]:
+                    ring = max(abs(bx), abs(by))
+                    put(ax + bx, ay + by, MODULE_ALIGNMENT, int(ring != 1))
     # Version Information
     if version >= 7:
-        if size - 11 <= x and y <= 5:
-            return False
-        if size - 11 <= y and x <= 5:
-            return False
-    return True
+        for i in range(6):
+            for j in range(3):
+                put(size - 11 + j, i, MODULE_VERSION)
+                put(i, size - 11 + j, MODULE_VERSION)
+    return (classes, values)
+
+def module_classes(version):
+    # モジュールの種類のbytearray (添字は y * size + x)
+    if version not in module_classes_table:
+        module_classes_table[version] = build_module_classes(version)
+    return module_classes_table[version][0]
+
+def function_pattern_values(version):
+    # 機能パターンの本来の値のbytearray (添字は y * size + x)
+    module_classes(version)
+    return module_classes_table[version][1]
+
+def in_payload_area(version, x, y):
+    size = version * 4 + 17
+    return module_classes(version)[y * size + x] == MODULE_DATA
+
+# (version, 種類): packed (シンボル全体を整数1つにまとめたもの)
+class_bitmap_table = {}
+
+def class_bitmap(version, c):
+    # 種類cのモジュールのビットが立った整数 (pack_modulesと同じ並び)
+    if (version, c) not in class_bitmap_table:
+        classes = module_classes(version)
+        bits = "".join(["1" if k == c else "0" for k in classes])
+        class_bitmap_table[(version, c)] = int(bits, 2)
+    return class_bitmap_table[(version, c)]
+
+def function_pattern_bitmap(version):
+    # 値が決まっている機能パターンの (本来の値, そのモジュールのマスク)
+    key = (version, "fixed")
+    if key not in class_bitmap_table:
+        values = function_pattern_values(version)
+        value = int("".join([str(v) for v in values]), 2)
+        mask = 0
+        for c in FIXED_MODULE_CLASSES:
+            mask |= class_bitmap(version, c)
+        class_bitmap_table[key] = (value & mask, mask)
+    return class_bitmap_table[key]
+
+def format_bitmap(version, f):
+    # Format Information fを置いたときの値 (packed, extract_formatの逆)
+    size = version * 4 + 17
+    (fl1, fl2) = format_coordinates(size)
+    value = 0
+    for i in range(15):
+        if (f >> (14 - i)) & 1:
+            for (x, y) in [fl1[i], fl2[i]]:
+                value |= 1 << (size * size - 1 - (y * size + x))
+    return value
+
+def version_bitmap(version):
+    # Version Informationの値 (packed, extract_versionの逆)
+    size = version * 4 + 17
+    (vl1, vl2) = version_coordinates(size)
+    v = gen_version(version)
+    value = 0
+    for i in range(18):
+        if (v >> (17 - i)) & 1:
+            for (x, y) in [vl1[i], vl2[i]]:
+                value |= 1 << (size * size - 1 - (y * size + x))
+    return value
+
+def function_pattern_damage(qr, ecl_mask = None):
+    # 機能パターンの壊れ具合
+    # {種類の名前: (本来と異なるモジュール数, 未知のモジュール数, 総数)}
+    # ecl_mask: (ecl, mask) を渡すとFormat Informationも調べる
+    # Version Information (version 7以上) はシンボルの大きさから調べる
+    version = get_version(qr)
+    size = len(qr)
+    (value, known) = pack_modules(qr)
+    (expected, fixed) = function_pattern_bitmap(version)
+    classes = list(FIXED_MODULE_CLASSES)
+    if ecl_mask is not None:
+        expected |= format_bitmap(version, gen_format(*ecl_mask))
+        classes.append(MODULE_FORMAT)
+    if version >= 7:
+        expected |= version_bitmap(version)
+        classes.append(MODULE_VERSION)
+    full = (1 << (size * size)) - 1
+    wrong = (value ^ expected) & known
+    unknown = ~known & full
+    damage = {}
+    for c in classes:
+        m = class_bitmap(version, c)
+        damage[MODULE_CLASS_NAMES[c]] = (popcount(wrong & m),
+                                         popcount(unknown & m), popcount(m))
+    return damage
 
 def zigzag(version):
     size = version * 4 + 17
@@ -553,6 +883,28 @@ def zigzag(version):
         y = size - 1
         x -= 2
 
+# version: [(x, y), ...]
+# データモジュールの座標を符号語・ビットの順(MSBから)に並べたもの
+payload_coordinates_table = {}
+
+def payload_coordinates(version):
+    if version not in payload_coordinates_table:
+        payload_coordinates_table[version] = [
+            (x, y) for (x, y) in zigzag(version)
+            if in_payload_area(version, x, y)]
+    return payload_coordinates_table[version]
+
+# version: [i, ...]
+# payload_coordinatesをpack_modulesの文字列表現での添字にしたもの
+payload_positions_table = {}
+
+def payload_positions(version):
+    if version not in payload_positions_table:
+        size = version * 4 + 17
+        payload_positions_table[version] = [
+            y * size + x for (x, y) in payload_coordinates(version)]
+    return payload_positions_table[version]
+
 def mask_at(m, x, y):
     if m == 0:
         flip = (y + x) % 2 == 0
@@ -575,101 +927,367 @@ def mask_at(m, x, y):
     else:
         return 0
 
-def extract_codewords(qr, m):
-    ver = get_version(qr)
-    codewords = []
-    k = 0
-    w = 0
-    wm = 0
-    for (x, y) in zigzag(ver):
-        if not in_payload_area(ver, x, y):
-            continue
-        # print (len(codewords), k, x, y)
-        if qr[y][x] is None:
-            w = w * 2
-            wm = wm * 2
+### Packed Modules ###
+# シンボル全体を整数1つにまとめたもの
+# 座標(x, y)はビット位置 size*size - 1 - (y*size + x) (つまり(0, 0)がMSB)
+# 値と既知/未知の2枚を使う
+
+# size: 全てのモジュールが既知のときのknown
+all_known_table = {}
+
+def all_known(size):
+    if size not in all_known_table:
+        all_known_table[size] = (1 << (size * size)) - 1
+    return all_known_table[size]
+
+class Symbol(object):
+    __slots__ = ("size", "value", "known")
+
+    def __init__(self, size, value = 0, known = None):
+        self.size = size
+        self.value = value
+        if known is None:
+            known = (1 << (size * size)) - 1
+        self.known = known
+
+    @classmethod
+    def from_rows(cls, qr):
+        (value, known) = pack_modules(qr)
+        return cls(len(qr), value, known)
+
+    def rows(self):
+        return unpack_modules(self.size, self.value, self.known)
+
+    def module(self, x, y):
+        if x < 0: x += self.size
+        if y < 0: y += self.size
+        shift = self.size * self.size - 1 - (y * self.size + x)
+        if (self.known >> shift) & 1 == 0:
+            return None
+        return (self.value >> shift) & 1
+
+    def set_module(self, x, y, c):
+        if x < 0: x += self.size
+        if y < 0: y += self.size
+        bit = 1 << (self.size * self.size - 1 - (y * self.size + x))
+        if c is None or c == -1:
+            self.known &= ~bit
+            self.value &= ~bit
         else:
-            w = w * 2 + (qr[y][x] ^ mask_at(m, x, y))
-            wm = wm * 2 + 1
-        k += 1
-        if k == 8:
-            if wm != 255:
-                codewords.append(Uncertain(w, wm))
+            self.known |= bit
+            if c:
+                self.value |= bit
             else:
-                codewords.append(w)
-            w = 0
-            wm = 0
-            k = 0
-    return codewords
+                self.value &= ~bit
+
+    # 互換性のため qr[y][x] でも読み書きできるようにする
+    # (行ごとに展開するので遅い. module(), set_module()を使うこと)
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, y):
+        if y < 0: y += self.size
+        if not 0 <= y < self.size:
+            raise IndexError("row out of range")
+        shift = self.size * (self.size - 1 - y)
+        rowmask = (1 << self.size) - 1
+        return SymbolRow(self, y, unpack_modules(self.size,
+                                                 (self.value >> shift) & rowmask,
+                                                 (self.known >> shift) & rowmask,
+                                                 1)[0])
+
+    def __eq__(self, other):
+        if not isinstance(other, Symbol):
+            return NotImplemented
+        return (self.size, self.value, self.known) == \
+            (other.size, other.value, other.known)
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        if r is NotImplemented:
+            return r
+        return not r
 
-def uninterleave(codewords, version, ecl):
-    (necc, gs) = correction_table[(version, ecl)]
-    
-    p = 0
+    def __repr__(self):
+        return "Symbol(" + repr(self.size) + ", ...)"
+
+class SymbolRow(list):
+    # Symbolの1行 (qr[y][x] = c をSymbolに書き戻す)
+    __slots__ = ("symbol", "y")
+
+    def __init__(self, symbol, y, line):
+        list.__init__(self, line)
+        self.symbol = symbol
+        self.y = y
+
+    def __setitem__(self, x, c):
+        if isinstance(x, slice):
+            xs = range(*x.indices(len(self)))
+            c = list(c)
+            if len(c) != len(xs):
+                raise ValueError("cannot resize a symbol row")
+            for (i, v) in zip(xs, c):
+                self[i] = v
+            return
+        list.__setitem__(self, x, c)
+        self.symbol.set_module(x, self.y, c)
+
+    def __setslice__(self, i, j, c):
+        self.__setitem__(slice(i, j), c)
+
+    def __delitem__(self, x):
+        raise TypeError("cannot resize a symbol row")
+
+    def __delslice__(self, i, j):
+        raise TypeError("cannot resize a symbol row")
+
+def pack_modules(qr):
+    if isinstance(qr, Symbol):
+        return (qr.value, qr.known)
+    vs = []
+    ks = []
+    for line in qr:
+        for c in line:
+            # scanqrの古い出力では未知が-1
+            if c is None or c == -1:
+                vs.append("0")
+                ks.append("0")
+            else:
+                vs.append("1" if c == 1 else "0")
+                ks.append("1")
+    return (int("".join(vs), 2), int("".join(ks), 2))
+
+def unpack_modules(size, value, known, height = None):
+    if height is None:
+        height = size
+    n = size * height
+    vs = format(value, "0{}b".format(n))
+    ks = format(known, "0{}b".format(n))
+    qr = []
+    for y in range(height):
+        line = []
+        for i in range(y * size, (y + 1) * size):
+            if ks[i] == "0":
+                line.append(None)
+            else:
+                line.append(int(vs[i]))
+        qr.append(line)
+    return qr
 
-    affected = []
-    data_groups = []
-    for g in gs:
-        blocks = []
-        for i in range(g[0]):
-            blocks.append([])
-        data_groups.append(blocks)
-        
-        blocks = []
-        for i in range(g[0]):
-            blocks.append([])
-        affected.append(blocks)
+# (version, mask): packed mask
+mask_bitmap_table = {}
+
+def mask_bitmap(version, m):
+    # データモジュールのうちmask_atが1になる所だけを立てたもの
+    if (version, m) not in mask_bitmap_table:
+        size = version * 4 + 17
+        bits = ["0"] * (size * size)
+        for (x, y) in payload_coordinates(version):
+            if mask_at(m, x, y):
+                bits[y * size + x] = "1"
+        mask_bitmap_table[(version, m)] = int("".join(bits), 2)
+    return mask_bitmap_table[(version, m)]
+
+def unmask(qr, m):
+    ver = get_version(qr)
+    (value, known) = pack_modules(qr)
+    return Symbol(len(qr), value ^ mask_bitmap(ver, m), known)
+
+def codewords_from_packed(version, value, known):
+    # valueはマスク解除済みであること
+    size = version * 4 + 17
+    n = size * size
+    vs = format(value & known, "0{}b".format(n))
+    ks = format(known, "0{}b".format(n))
+    positions = payload_positions(version)
+    # 端数のremainder bitsは捨てる
+    nbits = len(positions) - len(positions) % 8
+    vbits = "".join([vs[i] for i in positions[:nbits]])
+    kbits = "".join([ks[i] for i in positions[:nbits]])
+    return Codewords(bits_to_bytes(vbits), bits_to_bytes(kbits))
+
+def bits_to_bytes(bits):
+    # "0"/"1"の文字列(長さは8の倍数)をbytearrayに
+    return bytearray(binascii.unhexlify(
+        "{:0{}x}".format(int(bits, 2), len(bits) // 4)))
 
-    ncol = max(map(lambda g: g[1], gs))
+def extract_codewords(qr, m):
+    ver = get_version(qr)
+    (value, known) = pack_modules(qr)
+    return codewords_from_packed(ver, value ^ mask_bitmap(ver, m), known)
 
-    for c in range(ncol):
-        for j in range(len(gs)):
-            if c >= gs[j][1]:
-                continue
-            for i in range(gs[j][0]):
-                data_groups[j][i].append(codewords[p])
-                affected[j][i].append(set([p]))
-                p += 1
-    
+def extract_codewords_all_masks(qr):
+    # Format Informationが壊れているときに全マスクを試す用
+    ver = get_version(qr)
+    (value, known) = pack_modules(qr)
+    return [codewords_from_packed(ver, value ^ mask_bitmap(ver, m), known)
+            for m in range(8)]
+
+### Soft Decision ###
+# confidence[y][x]: モジュールの判定の確からしさ (大きいほど確か, 未知は0)
+# 例えばscanqr.scan_confidenceが返す |輝度 - 閾値|
+
+def codeword_confidence(confidence, version):
+    # 符号語(extract_codewordsの並び)ごとの, 最も弱いモジュールの確からしさ
+    if hasattr(confidence, "tolist"):
+        confidence = confidence.tolist()
+    coords = payload_coordinates(version)
+    n = len(coords) // 8
+    return [min([confidence[y][x] for (x, y) in coords[8 * i:8 * i + 8]])
+            for i in range(n)]
+
+def block_positions(version, ecl):
+    # ブロックごとの符号語番号のリスト (データ + ECC, extract_codewordsの並び)
+    (necc, nblocks, nshort, nshortblocks, ndata) = block_layout(version, ecl)
+    affected = AffectedMap(version, ecl)
+    blocks = []
+    for b in range(nblocks):
+        n = nshort if b < nshortblocks else nshort + 1
+        blocks.append([affected.data_position(b, c) for c in range(n)] +
+                      affected.ecc_positions(b))
+    return blocks
+
+def erase_weakest(codewords, weakness, version, ecl, budget = None,
+                  below = None):
+    # 各ブロックで確からしさの低い符号語から順に消失(未知)にする
+    # weakness: codeword_confidenceの戻り値
+    # budget: ブロックあたりの消失数の上限 (既に未知の符号語も数える)
+    #         省略時はECC長の半分 (残り半分で消失以外の誤りを訂正する)
+    # below: これ以上確かな符号語は消失にしない
+    # 誤りでない符号語を消失にすると訂正能力を無駄にするので,
+    # 普通はrecover_error_softで少しずつ増やしながら使う
+    codewords = as_codewords(codewords)
+    values = bytearray(codewords.values)
+    masks = bytearray(codewords.masks)
+    necc = block_layout(version, ecl)[0]
+    if budget is None:
+        budget = necc // 2
+    for positions in block_positions(version, ecl):
+        erased = len([i for i in positions if masks[i] != 255])
+        candidates = sorted([i for i in positions if masks[i] == 255],
+                            key=lambda i: weakness[i])
+        for i in candidates[:max(budget - erased, 0)]:
+            if below is not None and weakness[i] >= below:
+                break
+            values[i] = 0
+            masks[i] = 0
+    return Codewords(values, masks)
+
+def block_layout(version, ecl):
+    # (ECC長, ブロック数, 短いブロックのデータ長, 短いブロック数, データ符号語数)
+    # 短いブロックが先で, 長いブロックはデータが1つ多い
+    (necc, gs) = correction_table[(version, ecl)]
+    nblocks = sum(map(lambda g: g[0], gs))
+    nshort = min(map(lambda g: g[1], filter(lambda g: g[0] > 0, gs)))
+    nshortblocks = sum(map(lambda g: g[0], filter(lambda g: g[1] == nshort, gs)))
+    ndata = sum(map(lambda g: g[0] * g[1], gs))
+    return (necc, nblocks, nshort, nshortblocks, ndata)
+
+def uninterleave(codewords, version, ecl):
+    gs = correction_table[(version, ecl)][1]
+    (necc, nblocks, nshort, nshortblocks, ndata) = block_layout(version, ecl)
+    codewords = as_codewords(codewords)
+
+    # 各ブロックの符号語は一定間隔で並んでいるので, スライスで取り出せる
+    # (長いブロックだけ最後の1列が余分にある)
+    data_groups = []
     ecc_groups = []
+    b = 0
     for g in gs:
-        blocks = []
+        dblocks = []
+        eblocks = []
         for i in range(g[0]):
-            blocks.append([])
-        ecc_groups.append(blocks)
-    
-    for c in range(necc):
-        for j in range(len(gs)):
-            for i in range(gs[j][0]):
-                ecc_groups[j][i].append(codewords[p])
-                for c in range(gs[j][1]):
-                    affected[j][i][c].add(p)
-                p += 1
+            block = codewords[b:nshort * nblocks:nblocks]
+            if g[1] > nshort:
+                p = nshort * nblocks + b - nshortblocks
+                block = block + codewords[p:p + 1]
+            dblocks.append(block)
+            eblocks.append(codewords[ndata + b:ndata + necc * nblocks:nblocks])
+            b += 1
+        data_groups.append(dblocks)
+        ecc_groups.append(eblocks)
+
+    return (data_groups, ecc_groups, AffectedMap(version, ecl))
+
+class AffectedMap(object):
+    # データ符号語(groups_to_bytesの順)ごとの関連する符号語番号の集合
+    # (符号語番号はextract_codewordsの並びでの位置)
+    # 関連する符号語 = その符号語自身 + 同じブロックのECC符号語全て
+    # 集合は読まれた時に作るので, affectionを使わなければ何もしない
+    __slots__ = ("version", "ecl", "layout")
+
+    def __init__(self, version, ecl):
+        self.version = version
+        self.ecl = ecl
+        self.layout = block_layout(version, ecl)
+
+    def __len__(self):
+        return self.layout[4]
+
+    def locate(self, k):
+        # k番目のデータ符号語の (ブロック番号, ブロック内の位置)
+        (necc, nblocks, nshort, nshortblocks, ndata) = self.layout
+        if k < nshort * nshortblocks:
+            return (k / nshort, k % nshort)
+        k -= nshort * nshortblocks
+        return (nshortblocks + k / (nshort + 1), k % (nshort + 1))
+
+    def data_position(self, b, c):
+        (necc, nblocks, nshort, nshortblocks, ndata) = self.layout
+        if c < nshort:
+            return c * nblocks + b
+        return nshort * nblocks + b - nshortblocks
+
+    def ecc_positions(self, b):
+        (necc, nblocks, nshort, nshortblocks, ndata) = self.layout
+        return range(ndata + b, ndata + necc * nblocks, nblocks)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("codeword out of range")
+        (b, c) = self.locate(k)
+        s = set(self.ecc_positions(b))
+        s.add(self.data_position(b, c))
+        return s
+
+    def union(self, p, q):
+        # p番目からq番目の手前までのデータ符号語に関連する符号語番号の集合
+        result = set()
+        blocks = set()
+        for k in range(max(p, 0), min(q, len(self))):
+            (b, c) = self.locate(k)
+            result.add(self.data_position(b, c))
+            blocks.add(b)
+        for b in blocks:
+            result.update(self.ecc_positions(b))
+        return result
 
-    return (data_groups, ecc_groups, affected)
+byte_bits_table = ["{:08b}".format(c) for c in range(256)]
 
 def groups_to_bitstring(groups):
-    s = ""
+    s = []
     for g in groups:
         for b in g:
-            for c in b:
-                if isinstance(c, Uncertain):
-                    t = ""
-                    for i in range(8):
-                        m = 1 << i
-                        if c.mask & m:
-                            if c.value & m:
-                                t += "1"
-                            else:
-                                t += "0"
-                        else:
-                            t += "0" # "?"
-                    s += t[::-1]
-                else:
-                    s += "{:08b}".format(c)
-    return s
+            # 未知のビットは"0"にする
+            for c in as_codewords(b).values:
+                s.append(byte_bits_table[c])
+    return "".join(s)
+
+def groups_to_bytes(groups):
+    # 全てのデータ符号語を直列に並べたbytearray (未知のビットは0)
+    data = bytearray()
+    for g in groups:
+        for b in g:
+            data += as_codewords(b).values
+    return data
 
 def flatten_affected(nested_affected):
+    if isinstance(nested_affected, AffectedMap):
+        return nested_affected
     affected = []
     for g in nested_affected:
         for b in g:
@@ -681,67 +1299,592 @@ def flatten_affected(nested_affected):
 def bits_affected(affected, p, q):
     pb = p / 8
     qb = (q + 7) / 8
+    if isinstance(affected, AffectedMap):
+        return affected.union(pb, qb)
     result = set()
     for s in affected[pb:qb]:
         result.update(s)
     return result
 
 ### Error Correction ###
+## GF(2^8): 原始多項式 0x11d, 生成元 2 (QRコードのRS符号)
+gf_exp = [0] * 510
+gf_log = [0] * 256
+
+def init_gf_tables():
+    x = 1
+    for i in range(255):
+        gf_exp[i] = x
+        gf_log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    for i in range(255, 510):
+        gf_exp[i] = gf_exp[i - 255]
+
+init_gf_tables()
+
+# "exp", "log": numpy版のgf_exp, gf_log
+gf_numpy_tables = {}
+
+def gf_numpy():
+    import numpy
+    if not gf_numpy_tables:
+        gf_numpy_tables["exp"] = numpy.array(gf_exp, dtype=numpy.intp)
+        gf_numpy_tables["log"] = numpy.array(gf_log, dtype=numpy.intp)
+    return (gf_numpy_tables["exp"], gf_numpy_tables["log"])
+
+# [numpyがあるか] (sys.pathを探すので最初の1回だけ調べる)
+has_numpy_cache = []
+
+def has_numpy():
+    # 読み込まずに有無だけを調べる
+    if not has_numpy_cache:
+        try:
+            imp.find_module("numpy")
+            has_numpy_cache.append(True)
+        except ImportError:
+            has_numpy_cache.append(False)
+    return has_numpy_cache[0]
+
+def gf_mul_numpy(a, b):
+    (exp, log) = gf_numpy()
+    return exp[log[a] + log[b]] * ((a != 0) & (b != 0))
+
+def gf_div_numpy(a, b):
+    # bは0でないこと
+    (exp, log) = gf_numpy()
+    return exp[log[a] + 255 - log[b]] * (a != 0)
+
+def block_matrix(blocks):
+    # blocks: 符号語(data + ecc)のbytearrayのリスト
+    # 短いブロックは先頭を0で埋める (多項式としては変わらない)
+    import numpy
+    n = max(map(len, blocks))
+    c = numpy.zeros((len(blocks), n), dtype=numpy.intp)
+    for (i, b) in enumerate(blocks):
+        c[i, n - len(b):] = numpy.frombuffer(b, dtype=numpy.uint8)
+    return c
+
+# 一度に展開する項の数の上限 (ブロック数 × 次数 × 位置)
+# これを超えるブロックは分けて計算し, メモリ使用量をブロック数によらず抑える
+numpy_chunk_terms = 1 << 18
+
+def row_chunks(nrows, terms):
+    # 1行あたりterms個の項を展開するときの行の範囲
+    step = max(numpy_chunk_terms // max(terms, 1), 1)
+    return [(p, min(p + step, nrows)) for p in range(0, nrows, step)]
+
+def matrix_syndromes(c, nsym):
+    # 全ブロックのシンドローム S[b][j] = block_b(α^j) を一度に計算する
+    import numpy
+    (exp, log) = gf_numpy()
+    n = c.shape[1]
+    power = (numpy.arange(nsym)[:, None] *
+             numpy.arange(n - 1, -1, -1)[None, :]) % 255
+    synd = numpy.zeros((c.shape[0], nsym), dtype=numpy.intp)
+    for (p, q) in row_chunks(c.shape[0], nsym * n):
+        terms = exp[log[c[p:q]][:, None, :] + power[None, :, :]]
+        terms *= (c[p:q] != 0)[:, None, :]
+        synd[p:q] = numpy.bitwise_xor.reduce(terms, axis=2)
+    return synd
+
+def block_syndromes(blocks, nsym):
+    return matrix_syndromes(block_matrix(blocks), nsym)
+
+def poly_eval_inverse_numpy(poly, degrees):
+    # poly[b][j]: 係数(低次から), degrees: 位置ごとの次数d
+    # 各ブロック・各位置について poly_b(α^-d) を計算する
+    import numpy
+    (exp, log) = gf_numpy()
+    power = (-(numpy.arange(poly.shape[1])[:, None] *
+               degrees[None, :])) % 255
+    values = numpy.zeros((poly.shape[0], len(degrees)), dtype=numpy.intp)
+    for (p, q) in row_chunks(poly.shape[0], poly.shape[1] * len(degrees)):
+        terms = exp[log[poly[p:q]][:, :, None] + power[None, :, :]]
+        terms *= (poly[p:q] != 0)[:, :, None]
+        values[p:q] = numpy.bitwise_xor.reduce(terms, axis=1)
+    return values
+
+def decode_blocks(blocks, nsym, erasures = None):
+    # 同じECC長nsymのブロックをまとめてRS復号する
+    # (Berlekamp-Massey, Chien search, Forneyを2次元配列のまま行う)
+    # blocks: 符号語(data + ecc)のbytearrayのリスト
+    # erasures: ブロックごとの消失位置のリスト
+    # 戻り値: 訂正したdata + eccのbytearrayのリスト (訂正できなければNone)
+    import numpy
+    (exp, log) = gf_numpy()
+    nb = len(blocks)
+    if nb == 0:
+        return []
+    if erasures is None:
+        erasures = [[]] * nb
+    lengths = numpy.array(map(len, blocks))
+    c = block_matrix(blocks)
+    n = c.shape[1]
+    pad = n - lengths
+    ne = numpy.array(map(len, erasures))
+    # 位置iの次数 (ブロックの末尾が0次)
+    degrees = numpy.arange(n - 1, -1, -1)
+
+    # 消失位置多項式 Γ(x) = Π(1 + X_k x), X_k = α^(消失位置の次数)
+    gamma = numpy.zeros((nb, nsym + 1), dtype=numpy.intp)
+    gamma[:, 0] = 1
+    for k in range(min(ne.max(), nsym)):
+        xk = numpy.zeros(nb, dtype=numpy.intp)
+        for b in range(nb):
+            if k < ne[b]:
+                p = pad[b] + erasures[b][k]
+                c[b, p] = 0
+                xk[b] = exp[degrees[p]]
+        gamma[:, 1:] ^= gf_mul_numpy(xk[:, None], gamma[:, :-1])
+
+    synd = matrix_syndromes(c, nsym)
+
+    # Berlekamp-Massey (消失位置多項式から始める)
+    lam = gamma.copy()
+    prev = gamma.copy()
+    l = ne.copy()
+    for k in range(nsym):
+        active = k >= ne
+        sk = numpy.zeros((nb, nsym + 1), dtype=numpy.intp)
+        sk[:, :k + 1] = synd[:, k::-1]
+        delta = numpy.bitwise_xor.reduce(gf_mul_numpy(lam, sk), axis=1)
+        delta *= active
+        xprev = numpy.zeros_like(prev)
+        xprev[:, 1:] = prev[:, :-1]
+        nonzero = delta != 0
+        grow = nonzero & (2 * l <= k + ne)
+        lam_next = lam ^ gf_mul_numpy(delta[:, None], xprev)
+        inv = gf_div_numpy(numpy.ones_like(delta), numpy.where(nonzero, delta, 1))
+        prev_next = numpy.where(grow[:, None],
+                                gf_mul_numpy(inv[:, None], lam), xprev)
+        prev = numpy.where(active[:, None], prev_next, prev)
+        l = numpy.where(grow, k + 1 + ne - l, l)
+        lam = numpy.where(nonzero[:, None], lam_next, lam)
+
+    deg = nsym - numpy.argmax(lam[:, ::-1] != 0, axis=1)
+    ok = (deg == l) & (ne <= nsym) & (2 * l - ne <= nsym)
+
+    # Chien search
+    real = numpy.arange(n)[None, :] >= pad[:, None]
+    roots = (poly_eval_inverse_numpy(lam, degrees) == 0) & real
+    ok &= roots.sum(axis=1) == deg
+
+    # Forney: e = X Ω(X^-1) / Λ'(X^-1), Ω(x) = S(x)Λ(x) mod x^nsym
+    omega = numpy.zeros((nb, nsym), dtype=numpy.intp)
+    for i in range(nsym):
+        omega[:, i:] ^= gf_mul_numpy(lam[:, i:i + 1], synd[:, :nsym - i])
+    dlam = numpy.zeros((nb, nsym), dtype=numpy.intp)
+    dlam[:, 0::2] = lam[:, 1::2]
+    num = poly_eval_inverse_numpy(omega, degrees)
+    den = poly_eval_inverse_numpy(dlam, degrees)
+    ok &= ~(roots & (den == 0)).any(axis=1)
+    magnitude = gf_mul_numpy(exp[degrees % 255][None, :],
+                             gf_div_numpy(num, numpy.where(den == 0, 1, den)))
+    corrected = c ^ numpy.where(roots, magnitude, 0)
+
+    # 訂正結果のシンドロームが全て0であることを確認する
+    ok &= (matrix_syndromes(corrected, nsym) == 0).all(axis=1)
+
+    results = []
+    for b in range(nb):
+        if ok[b]:
+            block = corrected[b, pad[b]:].astype(numpy.uint8)
+            results.append(bytearray(block.tostring()))
+        else:
+            results.append(None)
+    return results
+
+# ECC長: reedsolo.RSCodec
+rs_codecs = {}
+
+def rs_codec(necc):
+    if necc not in rs_codecs:
+        rs_codecs[necc] = reedsolo.RSCodec(necc)
+    return rs_codecs[necc]
+
 def recover_error_block(data_block, ecc_block):
-    rs = reedsolo.RSCodec(len(ecc_block))
-    d = map(lambda x: -1 if isinstance(x, Uncertain) else x, data_block)
-    e = map(lambda x: -1 if isinstance(x, Uncertain) else x, ecc_block)
-    decoded = rs.decode(d + e)
-    return decoded
-
-## TODO: Support reedsolo.ReedSolomonError
-def recover_error(data_groups, ecc_groups):
-    groups = []
-    for (dg, eg) in zip(data_groups, ecc_groups):
-        blocks = []
-        for (db, eb) in zip(dg, eg):
-            blocks.append(recover_error_block(db, eb))
-        groups.append(blocks)
+    block = as_codewords(data_block) + as_codewords(ecc_block)
+    rs = rs_codec(len(ecc_block))
+    # 未知のビットを含む符号語は消失(erasure)として位置を渡す
+    # (誤りの半分の訂正能力で済む)
+    decoded = rs.decode(block.values, erase_pos=block.uncertain_positions())
+    return decoded[0]
+
+def recover_error(data_groups, ecc_groups, stats = None, engine = None,
+                  executor = None):
+    # stats: dictを渡すと "blocks" (ブロック数),
+    #        "fast_path" (シンドロームが0で訂正を省略したブロック数),
+    #        "failures" (訂正できなかったブロック数),
+    #        "failed_blocks" (訂正できなかった(シンボル, グループ, ブロック))
+    #        を加算する
+    # engine: "numpy" (decode_blocks) か "reedsolo" (recover_error_block)
+    #         省略時はnumpyがあればnumpy
+    # executor: concurrent.futures.ProcessPoolExecutor等 (mapを持つもの)
+    #           ブロックを分けて並列に復号する
+    groups = recover_errors([(data_groups, ecc_groups)], stats, engine,
+                            executor)[0]
+    if groups is None:
+        raise reedsolo.ReedSolomonError("Could not correct message")
     return groups
 
+def recover_errors(symbols, stats = None, engine = None, executor = None,
+                   chunksize = 16, keep_failed = False):
+    # symbols: [(data_groups, ecc_groups), ...]
+    # ECC長が同じブロックはシンボルをまたいでまとめて復号する
+    # executorがあればchunksizeブロックずつに分けて並列に復号する
+    # (結果の順序はexecutorの有無によらない)
+    # 戻り値: シンボルごとの訂正済みdata_groups (訂正できなければNone)
+    # keep_failed: Trueなら訂正できなかったブロックだけを訂正前の
+    #              データ符号語にして, 常にdata_groupsを返す
+    #              (どのブロックかはstatsの "failed_blocks" で分かる)
+    if engine is None:
+        engine = "numpy" if has_numpy() else "reedsolo"
+    assert engine in ["numpy", "reedsolo"]
+
+    # nsym: [((シンボル, グループ, ブロック), データ長, data + ecc)]
+    by_nsym = {}
+    for (k, (data_groups, ecc_groups)) in enumerate(symbols):
+        for (j, (dg, eg)) in enumerate(zip(data_groups, ecc_groups)):
+            for (i, (db, eb)) in enumerate(zip(dg, eg)):
+                block = as_codewords(db) + as_codewords(eb)
+                by_nsym.setdefault(len(eb), []).append(((k, j, i), len(db), block))
+
+    decoded = {}
+    failed_keys = set()
+    nblocks = 0
+    nfast = 0
+    for nsym in sorted(by_nsym):
+        entries = by_nsym[nsym]
+        blocks = [entry[2] for entry in entries]
+        clean = screen_blocks(blocks, nsym)
+        rest = [(blocks[b].values, blocks[b].masks)
+                for b in range(len(entries)) if not clean[b]]
+        if executor is None:
+            # 一度に復号するブロックを制限してメモリ使用量を抑える
+            n = max([len(values) for (values, masks) in rest] + [0])
+            results = []
+            for (p, q) in row_chunks(len(rest), n):
+                results.extend(decode_block_chunk((engine, nsym, rest[p:q])))
+        else:
+            chunks = [(engine, nsym, rest[p:p + chunksize])
+                      for p in range(0, len(rest), chunksize)]
+            results = []
+            for r in executor.map(decode_block_chunk, chunks):
+                results.extend(r)
+        results = iter(results)
+        for (b, (key, ndata, block)) in enumerate(entries):
+            if clean[b]:
+                decoded[key] = bytearray(block.values[:ndata])
+            else:
+                r = next(results)
+                if r is not None:
+                    decoded[key] = r[:ndata]
+                elif keep_failed:
+                    failed_keys.add(key)
+                    decoded[key] = bytearray(block.values[:ndata])
+                else:
+                    decoded[key] = None
+        nblocks += len(entries)
+        nfast += clean.count(True)
+
+    outputs = []
+    failed = []
+    for (k, (data_groups, ecc_groups)) in enumerate(symbols):
+        groups = []
+        for (j, dg) in enumerate(data_groups):
+            groups.append([decoded[(k, j, i)] for i in range(len(dg))])
+            failed += [(k, j, i) for i in range(len(dg))
+                       if decoded[(k, j, i)] is None or
+                       (k, j, i) in failed_keys]
+        if failed and failed[-1][0] == k and not keep_failed:
+            outputs.append(None)
+        else:
+            outputs.append(groups)
+
+    if stats is not None:
+        stats["blocks"] = stats.get("blocks", 0) + nblocks
+        stats["fast_path"] = stats.get("fast_path", 0) + nfast
+        stats["failures"] = stats.get("failures", 0) + len(failed)
+        stats["failed_blocks"] = stats.get("failed_blocks", []) + failed
+    return outputs
+
+def recover_error_soft(codewords, weakness, version, ecl, stats = None,
+                       engine = None, budgets = None):
+    # 確からしさを使ったエラー訂正 (extract_codewordsの並びの符号語を渡す)
+    # まず硬判定のまま訂正し, 訂正できなかったブロックだけ
+    # 弱い符号語をbudgetsの個数ずつ消失にして訂正し直す
+    # budgets: 省略時は 2, 4, ..., ECC長の3/4
+    #          (消失ばかりで冗長性が残らないと誤訂正を見逃すので全部は使わない)
+    # stats: recover_errorと同じ (やり直した分も加算する)
+    #        "soft_retries" (やり直したブロック数) も加算する
+    # 戻り値: recover_errorと同じ訂正済みdata_groups
+    necc = block_layout(version, ecl)[0]
+    if budgets is None:
+        budgets = range(2, necc * 3 // 4 + 1, 2)
+    # ブロック1つずつを別のシンボルとしてrecover_errorsに渡す
+    keys = []
+    pending = []
+    (data_groups, ecc_groups, affected) = uninterleave(codewords, version, ecl)
+    for (j, (dg, eg)) in enumerate(zip(data_groups, ecc_groups)):
+        for (i, (db, eb)) in enumerate(zip(dg, eg)):
+            keys.append((j, i))
+            pending.append(([[db]], [[eb]]))
+    results = {}
+    retries = 0
+    for budget in [None] + list(budgets):
+        if budget is not None:
+            if not keys:
+                break
+            retries += len(keys)
+            erased = erase_weakest(codewords, weakness, version, ecl, budget)
+            (dgs, egs, affected) = uninterleave(erased, version, ecl)
+            pending = [([[dgs[j][i]]], [[egs[j][i]]]) for (j, i) in keys]
+        outputs = recover_errors(pending, None, engine)
+        rest = []
+        for (key, out) in zip(keys, outputs):
+            if out is None:
+                rest.append(key)
+            else:
+                results[key] = out[0][0]
+        keys = rest
+
+    if stats is not None:
+        nblocks = sum(map(len, data_groups))
+        stats["blocks"] = stats.get("blocks", 0) + nblocks
+        stats["soft_retries"] = stats.get("soft_retries", 0) + retries
+        stats["failures"] = stats.get("failures", 0) + len(keys)
+        stats["failed_blocks"] = (stats.get("failed_blocks", []) +
+                                  [(0, j, i) for (j, i) in keys])
+    if keys:
+        raise reedsolo.ReedSolomonError("Could not correct message")
+    return [[results[(j, i)] for i in range(len(dg))]
+            for (j, dg) in enumerate(data_groups)]
+
+def decode_block_chunk(args):
+    # recover_errorsの下請け (executorから呼べるようにモジュール直下に置く)
+    # args: (engine, nsym, [(values, masks), ...])
+    # 戻り値: data + ecc (reedsoloの場合はdataのみ) か None のリスト
+    (engine, nsym, blocks) = args
+    blocks = [Codewords(values, masks) for (values, masks) in blocks]
+    if engine == "numpy":
+        return decode_blocks([b.values for b in blocks], nsym,
+                             [b.uncertain_positions() for b in blocks])
+    results = []
+    for b in blocks:
+        try:
+            results.append(recover_error_block(b[:-nsym], b[-nsym:]))
+        except reedsolo.ReedSolomonError:
+            results.append(None)
+    return results
+
+def screen_blocks(blocks, nsym):
+    # 誤りのない(消失がなくシンドロームが全て0の)ブロックならTrue
+    # numpyが無ければ全てFalse (全ブロックを復号器に回す)
+    if not has_numpy():
+        return [False] * len(blocks)
+    certain = [not b.uncertain_positions() for b in blocks]
+    targets = [b.values for (b, c) in zip(blocks, certain) if c]
+    if not targets:
+        return certain
+    synd = block_syndromes(targets, nsym)
+    zero = iter((synd == 0).all(axis=1).tolist())
+    return [c and next(zero) for c in certain]
+
 ### Decoding data ###
 
-def decode_numeric(bits):
-    assert len(bits) in [4, 7, 10]
-    l = {4: 1, 7: 2, 10: 3}[len(bits)]
-    x = int(bits, 2)
+class BitReader(object):
+    # バイト列をMSBから順にnビットずつ読む
+    __slots__ = ("data", "pos", "length")
+
+    def __init__(self, data, pos = 0, length = None):
+        self.data = bytearray(data)
+        self.pos = pos
+        if length is None:
+            length = len(self.data) * 8
+        self.length = length
+
+    @classmethod
+    def from_bitstring(cls, bits):
+        # "0"/"1"の文字列から
+        n = len(bits)
+        padded = bits + "0" * (-n % 8)
+        if not padded:
+            return cls(bytearray(), 0, 0)
+        return cls(bits_to_bytes(padded), 0, n)
+
+    def __len__(self):
+        return self.length
+
+    def peek(self, n, pos = None):
+        # 範囲外のビットは0として読む
+        if pos is None:
+            pos = self.pos
+        first = pos >> 3
+        last = (pos + n + 7) >> 3
+        x = 0
+        for c in self.data[first:last]:
+            x = (x << 8) | c
+        x <<= 8 * (last - max(first, min(last, len(self.data))))
+        x >>= last * 8 - (pos + n)
+        return x & ((1 << n) - 1)
+
+    def read(self, n):
+        pos = self.pos
+        i = pos >> 3
+        if n <= 17 and i + 3 <= len(self.data):
+            # 3バイト以内に収まる場合 (cciを含め普通はこちら)
+            d = self.data
+            x = (d[i] << 16) | (d[i + 1] << 8) | d[i + 2]
+            x = (x >> (24 - (pos & 7) - n)) & ((1 << n) - 1)
+        else:
+            x = self.peek(n)
+        self.pos = pos + n
+        return x
+
+    def skip(self, n):
+        self.pos += n
+
+    def read_int(self, n):
+        # nビットをまとめて読む (nが大きい場合用)
+        pos = self.pos
+        first = pos >> 3
+        last = (pos + n + 7) >> 3
+        chunk = self.data[first:last]
+        chunk += b"\0" * (last - first - len(chunk))
+        self.pos = pos + n
+        if n == 0:
+            return 0
+        x = int(binascii.hexlify(chunk), 16)
+        x >>= last * 8 - (pos + n)
+        return x & ((1 << n) - 1)
+
+    def read_groups(self, width, count):
+        # widthビットずつcount個をまとめて読む
+        # (大きな整数をシフトし続けないように32個ずつ読んで切り出す)
+        mask = (1 << width) - 1
+        groups = []
+        while count > 0:
+            k = min(count, 32)
+            x = self.read_int(width * k)
+            groups.extend([(x >> shift) & mask
+                           for shift in range(width * (k - 1), -1, -width)])
+            count -= k
+        return groups
+
+    def read_bytes(self, count):
+        # countバイト分をstrとして読む
+        if self.pos & 7 == 0:
+            first = self.pos >> 3
+            chunk = self.data[first:first + count]
+            chunk += b"\0" * (count - len(chunk))
+            self.pos += count * 8
+            return str(chunk)
+        if count == 0:
+            return ""
+        x = self.read_int(count * 8)
+        return binascii.unhexlify("{:0{}x}".format(x, count * 2))
+
+    def remaining(self):
+        return self.length - self.pos
+
+def as_bitreader(bits):
+    # BitReader, 符号語のbytearray, "0"/"1"の文字列を受け付ける
+    if isinstance(bits, BitReader):
+        return bits
+    if isinstance(bits, bytearray):
+        return BitReader(bits)
+    return BitReader.from_bitstring(bits)
+
+numeric_bits = {1: 4, 2: 7, 3: 10}
+def decode_numeric(reader, digits):
+    assert digits in [1, 2, 3]
+    x = reader.read(numeric_bits[digits])
     # TODO: when out of range raise error
-    return ("000" + str(x))[-l:]
+    return ("000" + str(x))[-digits:]
     
 alphanumeric_table = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R", "S", "T", "U", "V", "W", "X", "Y", "Z", " ", "$", "%", "*", "+", "-", ".", "/", ":"]
-def decode_alphanumeric(bits):
-    assert len(bits) == 6 or len(bits) == 11
-    x = int(bits, 2)
-    if len(bits) == 6:
-        # TODO: when x >= 45 raise error
-        return alphanumeric_table[x]
-    elif len(bits) == 11:
-        # TODO: when x / 45 >= 45 raise error
-        return alphanumeric_table[x / 45] + alphanumeric_table[x % 45]
-
-def decode_byte(bits):
-    assert len(bits) == 8
-    return chr(int(bits, 2))
-
-def decode_kanji(bits):
-    assert len(bits) == 13
-    x = int(bits, 2)
-    if x < 0x1F00:
-        # between 0x8140 and 0x9FFC
-        x += 0x8140
-    else:
-        # between 0xE040 and 0xEBBF
-        x += 0xC140
-    # TODO: when out of range raise error
+# 範囲外(45以上)の英数字の代わりに出力する文字
+ALPHANUMERIC_INVALID = u"\ufffd"
+
+def alphanumeric_char(x):
+    if x >= len(alphanumeric_table):
+        return ALPHANUMERIC_INVALID
+    return alphanumeric_table[x]
+
+def decode_alphanumeric(reader, chars):
+    assert chars == 1 or chars == 2
+    if chars == 1:
+        return alphanumeric_char(reader.read(6))
+    elif chars == 2:
+        x = reader.read(11)
+        return alphanumeric_char(x / 45) + alphanumeric_char(x % 45)
+
+def decode_byte(reader):
+    return chr(reader.read(8))
+
+# 13ビット -> Unicode文字 (Shift_JISとして不正な所はNone)
+kanji_table = []
+
+def get_kanji_table():
+    if not kanji_table:
+        import codecs
+        decode_sjis = codecs.getdecoder("shiftjis")
+        for x in range(8192):
+            # 上位バイト * 0xC0 + 下位バイト に圧縮されている
+            x = ((x / 0xC0) << 8) | (x % 0xC0)
+            if x < 0x1F00:
+                # between 0x8140 and 0x9FFC
+                c = x + 0x8140
+            else:
+                # between 0xE040 and 0xEBBF
+                c = x + 0xC140
+            try:
+                u = decode_sjis(chr(c >> 8) + chr(c & 255))[0]
+            except UnicodeDecodeError:
+                u = None
+            if u is not None and len(u) != 1:
+                u = None
+            kanji_table.append(u)
+    return kanji_table
+
+# 不正な漢字の代わりに出力する文字
+KANJI_INVALID = u"\ufffd"
+
+def decode_kanji(reader):
+    u = get_kanji_table()[reader.read(13)]
+    if u is None:
+        return KANJI_INVALID
+    return u
+
+## まとめて復号する版 (affectionが要らない場合)
+# 10ビット -> 3桁 (1000以上はdecode_numericと同じく下3桁)
+numeric_table = [("000" + str(x))[-3:] for x in range(1024)]
+# 11ビット -> 2文字 (2025以上はdecode_alphanumericと同じく1文字目が不正)
+alphanumeric_pair_table = [
+    alphanumeric_char(x / 45) + alphanumeric_char(x % 45) for x in range(2048)]
+
+def decode_numeric_run(reader, count):
+    s = "".join([numeric_table[x] for x in reader.read_groups(10, count / 3)])
+    if count % 3:
+        s += decode_numeric(reader, count % 3)
+    return s
+
+def decode_alphanumeric_run(reader, count):
+    s = "".join([alphanumeric_pair_table[x]
+                 for x in reader.read_groups(11, count / 2)])
+    if count % 2:
+        s += decode_alphanumeric(reader, 1)
+    return s
 
-    import codecs
-    decode_sjis = codecs.getdecoder("shiftjis")
-    return decode_sjis(chr(x >> 8) + chr(x & 255))[0]
+def decode_byte_run(reader, count):
+    return reader.read_bytes(count)
+
+def decode_kanji_run(reader, count):
+    table = get_kanji_table()
+    return u"".join([table[x] or KANJI_INVALID
+                     for x in reader.read_groups(13, count)])
 
     
 MODE_NUM   = 0b0001
@@ -784,71 +1927,583 @@ def ccilen(version, mode):
 
 def decode_segment(bits, first, version, affected=None,
                    force_mode=None, force_cci=None):
-    p = first
-    q = p + 4
-    if q > len(bits):
-        return ("", [], len(bits) - first, True)
+    # bits: BitReader, 符号語のbytearray, "0"/"1"の文字列のいずれか
+    reader = as_bitreader(bits)
+    reader.pos = first
+    if first + 4 > len(reader):
+        return ("", [], len(reader) - first, True)
     if force_mode is None:
-        mode = int(bits[p:q], 2)
+        mode = reader.read(4)
     else:
         mode = force_mode
-    p = q
+        reader.skip(4)
     if mode == 0:
-        return ("", [], q - first, True)
+        return ("", [], reader.pos - first, True)
 
-    q = p + ccilen(version, mode)
     if force_cci is None:
-        cci = int(bits[p:q], 2)
+        cci = reader.read(ccilen(version, mode))
     else:
         cci = force_cci
+        reader.skip(ccilen(version, mode))
     # print cci
-    p = q
 
     affection = []
 
+    if affected is None:
+        if mode == MODE_NUM:
+            s = decode_numeric_run(reader, cci)
+        elif mode == MODE_ALNUM:
+            s = decode_alphanumeric_run(reader, cci)
+        elif mode == MODE_BYTE:
+            s = decode_byte_run(reader, cci)
+        elif mode == MODE_KANJI:
+            s = decode_kanji_run(reader, cci)
+        return (s, affection, reader.pos - first, False)
+
     s = ""
     # FIXME: 途中で終わっても無限ループ・クラッシュしないように
     while len(s) < cci:
-        # print bits[p:]
-        # print s
+        p = reader.pos
         if mode == MODE_NUM:
-            if cci - len(s) > 2:
-                q = p + 10
-            elif cci - len(s) == 2:
-                q = p + 7
-            else:
-                q = p + 4
-            r = decode_numeric(bits[p:q])
+            r = decode_numeric(reader, min(cci - len(s), 3))
         elif mode == MODE_ALNUM:
-            if cci - len(s) > 1:
-                q = p + 11
-            else:
-                q = p + 6
-            r = decode_alphanumeric(bits[p:q])
+            r = decode_alphanumeric(reader, min(cci - len(s), 2))
         elif mode == MODE_BYTE:
-            q = p + 8
-            r = decode_byte(bits[p:q])
+            r = decode_byte(reader)
         elif mode == MODE_KANJI:
-            q = p + 13
-            r = decode_kanji(bits[p:q])
+            r = decode_kanji(reader)
         s += r
         if affected is not None:
-            affection.append((r, bits_affected(affected, p, q)))
-        p = q
-    return (s, affection, q - first, False)
+            affection.append((r, bits_affected(affected, p, reader.pos)))
+    return (s, affection, reader.pos - first, False)
+
+def join_text(parts):
+    # 漢字や不正な文字(unicode)とバイト(str)が混ざるときは
+    # バイトをISO-8859-1として読む
+    if any(isinstance(s, unicode) for s in parts):
+        parts = [s if isinstance(s, unicode) else s.decode("latin-1")
+                 for s in parts]
+    return "".join(parts)
 
 def decode(bits, version, affected=None):
+    reader = as_bitreader(bits)
     p = 0
-    result = ""
+    parts = []
     affection = []
     while True:
-        (s, a, read, stop) = decode_segment(bits, p, version, affected)
+        (s, a, read, stop) = decode_segment(reader, p, version, affected)
         if stop:
             break
         p += read
-        result += s
+        parts.append(s)
         affection += a
-    return (result, affection)
+    return (join_text(parts), affection)
+
+### Hypothesis Search ###
+# Format Informationが壊れていると最も近い候補が正しいとは限らないので,
+# 上位の候補 (とversionの候補ごとのシンボル) を実際に訂正・復号して確かめる
+
+def syndrome_weight(data_groups, ecc_groups):
+    # 全ブロックの0でないシンドロームの数 (誤りが少ないほど小さい)
+    by_nsym = {}
+    for (dg, eg) in zip(data_groups, ecc_groups):
+        for (db, eb) in zip(dg, eg):
+            block = as_codewords(db) + as_codewords(eb)
+            by_nsym.setdefault(len(eb), []).append(block.values)
+    weight = 0
+    for (nsym, blocks) in by_nsym.items():
+        if has_numpy():
+            weight += int((block_syndromes(blocks, nsym) != 0).sum())
+        else:
+            rs_codec(nsym)
+            for b in blocks:
+                synd = reedsolo.rs_calc_syndromes(b, nsym)[1:]
+                weight += len([x for x in synd if x != 0])
+    return weight
+
+def format_hypotheses(qr, k = 4):
+    # 距離の近い順に上位k個の (距離, (ecl, mask))
+    # k番目と同じ距離の候補も含める (kが0以下なら候補なし)
+    if k <= 0:
+        return []
+    formats = match_format(extract_format(qr))
+    limit = formats[min(k, len(formats)) - 1][0]
+    return [(f[0], f[3]) for f in formats if f[0] <= limit]
+
+def hypothesis_groups(qr, ecl, mask):
+    # (ecl, mask)を仮定して読んだ (data_groups, ecc_groups)
+    codewords = extract_codewords(qr, mask)
+    (data_groups, ecc_groups, affected) = \
+        uninterleave(codewords, get_version(qr), ecl)
+    return (data_groups, ecc_groups)
+
+def try_hypothesis(args):
+    # search_hypothesesの下請け (executorから呼べるようにモジュール直下に置く)
+    # args: (size, value, known, ecl, mask, engine)
+    # 戻り値: (成功したか, 文字列, エラー)
+    (size, value, known, ecl, mask, engine) = args
+    qr = Symbol(size, value, known)
+    (data_groups, ecc_groups) = hypothesis_groups(qr, ecl, mask)
+    corrected = recover_errors([(data_groups, ecc_groups)], None, engine)[0]
+    if corrected is None:
+        return (False, None, "Can't recover errors")
+    try:
+        (s, affection) = decode(groups_to_bytes(corrected), get_version(qr))
+    except (AssertionError, IndexError, ValueError):
+        return (False, None, "Can't decode data")
+    return (True, s, None)
+
+def search_hypotheses(symbols, k = 4, executor = None, engine = None):
+    # symbols: シンボル1つか, versionの候補ごとに読み取ったSymbolのリスト
+    #          (scanqr.scan_candidatesの戻り値など)
+    # k: シンボルごとに試すFormat Informationの候補の数 (0以下なら何もしない)
+    # executor: concurrent.futures.ProcessPoolExecutor等
+    #           候補を並列に試す. 順位が上の候補が全て失敗した時点で
+    #           復号できている最上位の候補を選び, 残りを取り消す
+    #           (省略時は順に1つずつ試して, 復号できたら止める. 結果は同じ)
+    # 候補は Format Informationの距離 + Version Informationの距離 の順
+    # 距離が同じ候補はシンドロームの重みの小さい順 (訂正の前に全候補で計算する)
+    # 戻り値: (復号できた候補かNone, 試した候補のリスト(終わった順))
+    #         候補: {"symbol", "ecl", "mask", "version", "format_distance",
+    #                "version_distance", "syndrome_weight", "ok", "text",
+    #                "error"}
+    if isinstance(symbols, Symbol):
+        symbols = [symbols]
+    elif symbols and not isinstance(symbols[0], Symbol):
+        symbols = [Symbol.from_rows(symbols)]
+
+    hypotheses = []
+    for (i, qr) in enumerate(symbols):
+        version = get_version(qr)
+        vd = 0
+        if version >= 7:
+            vd = [v[0] for v in match_version(extract_version(qr))
+                  if v[3] == version][0]
+        for (d, (ecl, mask)) in format_hypotheses(qr, k):
+            (data_groups, ecc_groups) = hypothesis_groups(qr, ecl, mask)
+            hypotheses.append({
+                "symbol": i, "ecl": ecl, "mask": mask, "version": version,
+                "format_distance": d, "version_distance": vd,
+                "syndrome_weight": syndrome_weight(data_groups, ecc_groups),
+            })
+    hypotheses.sort(key=lambda h: (h["format_distance"] +
+                                   h["version_distance"],
+                                   h["syndrome_weight"], h["symbol"]))
+
+    def job(h):
+        qr = symbols[h["symbol"]]
+        return (qr.size, qr.value, qr.known, h["ecl"], h["mask"], engine)
+
+    def finish(h, r):
+        (h["ok"], h["text"], h["error"]) = r
+        tried.append(h)
+        return h["ok"]
+
+    tried = []
+    if executor is None:
+        for h in hypotheses:
+            if finish(h, try_hypothesis(job(h))):
+                return (h, tried)
+        return (None, tried)
+
+    from concurrent.futures import as_completed
+    futures = [executor.submit(try_hypothesis, job(h)) for h in hypotheses]
+    rank = dict((f, i) for (i, f) in enumerate(futures))
+    done = [False] * len(hypotheses)
+    best = 0
+    for f in as_completed(futures):
+        if f.cancelled():
+            continue
+        i = rank[f]
+        finish(hypotheses[i], f.result())
+        done[i] = True
+        # 上位の候補が全て失敗していれば決まる
+        while best < len(hypotheses) and done[best]:
+            if hypotheses[best]["ok"]:
+                for other in futures:
+                    other.cancel()
+                return (hypotheses[best], tried)
+            best += 1
+    return (None, tried)
+
+### Inspector ###
+# 読み込んだシンボルから文字列までの全工程
+# 工程ごとの時間と各種の数を記録して, statsで取り出すかhookで受け取る
+
+class Inspection(object):
+    # Inspector.inspectの結果 (途中の値も全て持つ)
+    # failed_blocks: 訂正できなかった (グループ, ブロック) のリスト
+    __slots__ = ("version", "formats", "versions", "ecl", "mask",
+                 "codewords", "data_groups", "ecc_groups", "affected",
+                 "corrected", "failed_blocks", "data", "text", "affection",
+                 "error")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def __repr__(self):
+        return "Inspection(version={}, ecl={}, mask={}, text={!r}, " \
+               "error={!r})".format(self.version, self.ecl, self.mask,
+                                    self.text, self.error)
+
+class Inspector(object):
+    # hook: hook(工程名, 経過時間(秒), {数の名前: 値}) を工程ごとに呼ぶ
+    #       工程名: "format", "version", "codewords", "uninterleave",
+    #               "recover_error", "decode", 最後にシンボル全体の "symbol"
+    # timing: Falseなら時間を測らない (経過時間は0になる)
+    # affection: Falseなら文字ごとの関連する符号語を求めない (速い)
+    # engine, executor: recover_errorに渡す
+    stages = ["format", "version", "codewords", "uninterleave",
+              "recover_error", "decode"]
+
+    def __init__(self, hook = None, timing = True, affection = True,
+                 engine = None, executor = None):
+        self.hook = hook
+        self.timing = timing
+        self.affection = affection
+        self.engine = engine
+        self.executor = executor
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict((name, 0.0) for name in self.stages)
+        self.calls = dict((name, 0) for name in self.stages)
+        self.counters = {
+            "symbols": 0,
+            "uncertain_codewords": 0,
+            "blocks": 0,
+            "blocks_corrected": 0,
+            "rs_failures": 0,
+            "symbols_failed": 0,
+        }
+        # 距離: 件数
+        self.format_distances = {}
+        self.version_distances = {}
+
+    def clock(self):
+        if self.timing:
+            return time.time()
+        return 0.0
+
+    def record(self, name, start, values = None):
+        # valuesはフックごとに新しいdictを渡す
+        if values is None:
+            values = {}
+        elapsed = self.clock() - start
+        if name in self.seconds:
+            self.seconds[name] += elapsed
+            self.calls[name] += 1
+        if self.hook is not None:
+            self.hook(name, elapsed, values)
+        return self.clock()
+
+    def inspect(self, qr, ecl_mask = None):
+        # 訂正できなかったブロックは訂正前のデータ符号語で復号を続けて,
+        # Inspection.errorに理由を書く (復号できなければtextはNone)
+        # ecl_mask: (ecl, mask) を指定すると最も近い候補の代わりに使う
+        #           (search_hypothesesで選んだものなど)
+        result = Inspection()
+        begin = t = self.clock()
+        result.version = version = get_version(qr)
+
+        result.formats = match_format(extract_format(qr))
+        if ecl_mask is None:
+            (d, d0, d1, (ecl, mask)) = result.formats[0]
+        else:
+            (ecl, mask) = ecl_mask
+            d = [f[0] for f in result.formats if f[3] == ecl_mask][0]
+        (result.ecl, result.mask) = (ecl, mask)
+        self.format_distances[d] = self.format_distances.get(d, 0) + 1
+        t = self.record("format", t, {"format_distance": d})
+
+        if version >= 7:
+            result.versions = match_version(extract_version(qr))
+            d = result.versions[0][0]
+            self.version_distances[d] = self.version_distances.get(d, 0) + 1
+            t = self.record("version", t, {"version_distance": d})
+
+        result.codewords = extract_codewords(qr, mask)
+        n = len(result.codewords.uncertain_positions())
+        self.counters["uncertain_codewords"] += n
+        t = self.record("codewords", t, {"uncertain_codewords": n})
+
+        (result.data_groups, result.ecc_groups, result.affected) = \
+            uninterleave(result.codewords, version, ecl)
+        t = self.record("uninterleave", t)
+
+        stats = {}
+        corrected = recover_errors([(result.data_groups, result.ecc_groups)],
+                                   stats, self.engine, self.executor,
+                                   keep_failed=True)[0]
+        result.failed_blocks = [(j, i) for (k, j, i) in stats["failed_blocks"]]
+        values = {
+            "blocks": stats["blocks"],
+            "blocks_corrected": (stats["blocks"] - stats["fast_path"] -
+                                 stats["failures"]),
+            "rs_failures": stats["failures"],
+        }
+        for (k, v) in values.items():
+            self.counters[k] += v
+        if result.failed_blocks:
+            result.error = "Can't recover errors"
+            self.counters["symbols_failed"] += 1
+        result.corrected = corrected
+        t = self.record("recover_error", t, values)
+
+        result.data = groups_to_bytes(corrected)
+        if self.affection:
+            affected = flatten_affected(result.affected)
+        else:
+            affected = None
+        try:
+            (result.text, result.affection) = \
+                decode(result.data, version, affected)
+        except (AssertionError, IndexError, ValueError):
+            # 想定外のビット列 (訂正できなかった場合に多い)
+            if result.error is None:
+                result.error = "Can't decode data"
+                self.counters["symbols_failed"] += 1
+        t = self.record("decode", t)
+
+        self.counters["symbols"] += 1
+        self.record("symbol", begin, {"failed": result.error is not None})
+        return result
+
+    def stats(self):
+        # その時点の記録のコピー
+        return {
+            "seconds": dict(self.seconds),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+            "format_distances": dict(self.format_distances),
+            "version_distances": dict(self.version_distances),
+        }
+
+### Inspection Session ###
+# 修復作業用: 途中の状態を保持して, モジュールを書き換えたときに
+# その符号語, そのRSブロック, 変わったビットを含む文字部分列だけを計算し直す
+
+# mode: (1単位の文字数, 1単位のビット数)
+unit_layout = {
+    MODE_NUM: (3, 10),
+    MODE_ALNUM: (2, 11),
+    MODE_BYTE: (1, 8),
+    MODE_KANJI: (1, 13),
+}
+
+def decode_unit(reader, mode, count):
+    # decode_segmentの1回分 (count文字)
+    if mode == MODE_NUM:
+        return decode_numeric(reader, count)
+    elif mode == MODE_ALNUM:
+        return decode_alphanumeric(reader, count)
+    elif mode == MODE_BYTE:
+        return decode_byte(reader)
+    elif mode == MODE_KANJI:
+        return decode_kanji(reader)
+
+class InspectionSession(object):
+    # segments: [[開始ビット, 本体の開始ビット, 終了ビット, mode, cci,
+    #             affection], ...]
+    #   affectionはdecodeと同じく [(文字部分列, 関連する符号語番号の集合)]
+    # stop: 復号が止まったビット位置, error: 止まった理由 (正常ならNone)
+    # failed_blocks: 訂正できなかったブロック番号の集合
+    #                (訂正前のデータ符号語のまま復号している)
+
+    def __init__(self, qr, ecl_mask = None, engine = None):
+        # ecl_mask: (ecl, mask) を固定する場合 (省略時はFormat Informationから)
+        (value, known) = pack_modules(qr)
+        self.symbol = Symbol(len(qr), value, known)
+        self.version = get_version(qr)
+        self.fixed_format = ecl_mask
+        self.engine = engine
+        self.rebuild()
+
+    def rebuild(self):
+        # 全工程をやり直す
+        version = self.version
+        if self.fixed_format is None:
+            formats = match_format(extract_format(self.symbol))
+            (self.ecl, self.mask) = formats[0][3]
+        else:
+            (self.ecl, self.mask) = self.fixed_format
+        self.codewords = extract_codewords(self.symbol, self.mask)
+        self.affected = AffectedMap(version, self.ecl)
+        self.blocks = block_positions(version, self.ecl)
+        self.necc = block_layout(version, self.ecl)[0]
+        self.block_of = [None] * len(self.codewords)
+        self.offsets = []
+        offset = 0
+        for (b, positions) in enumerate(self.blocks):
+            for k in positions:
+                self.block_of[k] = b
+            self.offsets.append(offset)
+            offset += len(positions) - self.necc
+        self.data = bytearray(offset)
+        self.failed_blocks = set()
+        self.correct_blocks(range(len(self.blocks)))
+        self.segments = []
+        self.stop = 0
+        self.error = None
+        self.decode_from(0, 0)
+
+    def correct_blocks(self, bs):
+        # ブロックをRS訂正してself.dataに書き込み, 変わったバイトの位置を返す
+        entries = []
+        for b in bs:
+            positions = self.blocks[b]
+            block = Codewords(
+                bytearray([self.codewords.values[k] for k in positions]),
+                bytearray([self.codewords.masks[k] for k in positions]))
+            n = len(positions) - self.necc
+            entries.append(([[block[:n]]], [[block[n:]]]))
+        stats = {}
+        outputs = recover_errors(entries, stats, self.engine,
+                                 keep_failed=True)
+        failed = set([k for (k, j, i) in stats["failed_blocks"]])
+        changed = []
+        for (n, (b, out)) in enumerate(zip(bs, outputs)):
+            if n in failed:
+                self.failed_blocks.add(b)
+            else:
+                self.failed_blocks.discard(b)
+            data = out[0][0]
+            offset = self.offsets[b]
+            for (i, c) in enumerate(data):
+                if self.data[offset + i] != c:
+                    self.data[offset + i] = c
+                    changed.append(offset + i)
+        return changed
+
+    def decode_one(self, reader, pos):
+        # posから1つの文字部分列, 終端ならNone
+        if pos + 4 > len(reader):
+            return None
+        mode = reader.peek(4, pos)
+        if mode == 0:
+            return None
+        n = ccilen(self.version, mode)
+        cci = reader.peek(n, pos + 4)
+        (s, affection, read, stop) = \
+            decode_segment(reader, pos, self.version, self.affected)
+        return [pos, pos + 4 + n, pos + read, mode, cci, affection]
+
+    def decode_from(self, i, pos, q = None):
+        # i番目の文字部分列(開始位置pos)から復号し直す
+        # qより後で元の文字部分列の境界に戻ったら, それ以降は元のまま使う
+        reader = BitReader(self.data)
+        starts = dict((seg[0], j) for (j, seg) in enumerate(self.segments)
+                      if j > i)
+        new = []
+        while True:
+            try:
+                seg = self.decode_one(reader, pos)
+                error = None
+            except (AssertionError, IndexError, ValueError):
+                seg = None
+                error = "Can't decode data"
+            if seg is None:
+                self.segments = self.segments[:i] + new
+                (self.stop, self.error) = (pos, error)
+                return
+            new.append(seg)
+            pos = seg[2]
+            if q is not None and pos >= q and pos in starts:
+                self.segments = self.segments[:i] + new + \
+                    self.segments[starts[pos]:]
+                return
+
+    def update_units(self, seg, p, q):
+        # 文字部分列の本体のうち [p, q) ビットに掛かる単位だけ復号し直す
+        (start, body, end, mode, cci, affection) = seg
+        (per, width) = unit_layout[mode]
+        reader = BitReader(self.data)
+        first = max(0, (p - body) // width)
+        last = min(len(affection) - 1, (q - 1 - body) // width)
+        for k in range(first, last + 1):
+            reader.pos = body + k * width
+            r = decode_unit(reader, mode, min(per, cci - k * per))
+            affection[k] = (r, affection[k][1])
+
+    def redecode(self, p, q):
+        # データの [p, q) ビットが変わったときに文字部分列を更新する
+        for (j, seg) in enumerate(self.segments):
+            if seg[2] <= p or q <= seg[0]:
+                continue
+            if p < seg[1]:
+                # modeかcciが変わったかもしれない
+                self.decode_from(j, seg[0], q)
+                return
+            try:
+                self.update_units(seg, p, q)
+            except (AssertionError, IndexError, ValueError):
+                self.decode_from(j, seg[0], q)
+                return
+        if self.error is not None or (p < self.stop + 4 and self.stop < q):
+            # 終端かその先が変わった
+            self.decode_from(len(self.segments), self.stop, q)
+
+    def set_module(self, x, y, c):
+        return self.set_modules([(x, y, c)])
+
+    def set_modules(self, changes):
+        # changes: [(x, y, 値)] (値はNoneか-1で未知)
+        # 戻り値: 値が変わったデータ符号語の位置 (groups_to_bytesの順)
+        version = self.version
+        size = self.symbol.size
+        classes = module_classes(version)
+        touched = set()
+        format_changed = False
+        for (x, y, c) in changes:
+            self.symbol.set_module(x, y, c)
+            kind = classes[y * size + x]
+            if kind == MODULE_DATA:
+                position = module_codeword(version, x, y)
+                if position is not None:
+                    touched.add(position[0])
+            elif kind == MODULE_FORMAT:
+                format_changed = True
+
+        if format_changed and self.fixed_format is None:
+            formats = match_format(extract_format(self.symbol))
+            if formats[0][3] != (self.ecl, self.mask):
+                self.rebuild()
+                return range(len(self.data))
+
+        modules = codeword_modules(version)
+        for k in touched:
+            (v, m) = (0, 0)
+            for (x, y) in modules[k]:
+                c = self.symbol.module(x, y)
+                v <<= 1
+                m <<= 1
+                if c is not None:
+                    v |= c ^ mask_at(self.mask, x, y)
+                    m |= 1
+            self.codewords.values[k] = v & m
+            self.codewords.masks[k] = m
+
+        changed = self.correct_blocks(sorted(set(
+            [self.block_of[k] for k in touched])))
+        # 連続した範囲ごとに文字部分列を更新する
+        runs = []
+        for i in sorted(changed):
+            if runs and runs[-1][1] == i:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1])
+        for (p, q) in runs:
+            self.redecode(p * 8, q * 8)
+        return changed
+
+    @property
+    def affection(self):
+        return [a for seg in self.segments for a in seg[5]]
+
+    @property
+    def text(self):
+        return join_text([s for (s, a) in self.affection])
 
 ### Test codes ###
 if __name__ == '__main__':
@@ -878,7 +2533,8 @@ if __name__ == '__main__':
     # 構造: groups[i]: group = blocks
     #       groups[i][j]: block = codewords
     #       groups[i][j][k]: codeword = 8 bits integer
-    #       affected[i][j][k]: そのデータ符号語に関連する符号語番号の集合
+    #       affected[k]: k番目のデータ符号語(groups_to_bytesの順)に
+    #                    関連する符号語番号の集合 (読んだ時に作られる)
     (data_groups, ecc_groups, affected) = uninterleave(codewords, version, ecl)
     # エラー訂正を試みて
     try:
@@ -886,14 +2542,14 @@ if __name__ == '__main__':
     except reedsolo.ReedSolomonError:
         print "Can't recover errors"
 
-    # 全てのデータを直列に並べてビット文字列("0","1"の文字列)にして
-    bitstring = groups_to_bitstring(data_groups)
-    print(bitstring)
+    # 全てのデータ符号語を直列に並べて
+    data = groups_to_bytes(data_groups)
+    print(groups_to_bitstring(data_groups))
     # QRコード用文字エンコーディングからUnicode文字列に復号して
     # (先頭が欠けているときはmodeやcciを指定してdecode_segmentを呼び出す)
     # 構造: affection[i]: ('シンボルからデコードされた文字列',
     #                      関連する符号語番号の集合)
-    (s, affection) = decode(bitstring, version,
+    (s, affection) = decode(data, version,
                             affected=flatten_affected(affected))
     # AUX: 復号された文字部分列と関係する符号語の場所の一覧を表示
     for i in range(len(affection)):
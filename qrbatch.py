@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# QR code inspector: batch processing
+#
+# 使い方: python qrbatch.py [-j 4] [-o out.jsonl] 入力...
+#   入力: .qrファイル, 画像ファイル, ディレクトリ(再帰的に探す)かglob
+#   出力: シンボル1つにつきJSON 1行
+#         {"file", "index", "bbox", "version", "ecl", "mask",
+#          "format_distances", "version_distances", "text", "error"}
+#   壊れた入力があっても "error" を書いて次の入力に進む
+
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import qr
+
+QR_EXTENSIONS = [".qr"]
+IMAGE_EXTENSIONS = [".png", ".bmp", ".gif", ".jpg", ".jpeg", ".tif", ".tiff"]
+
+def expand_inputs(args):
+    # ディレクトリとglobを展開して, 対象の拡張子のファイルだけを順に返す
+    extensions = QR_EXTENSIONS + IMAGE_EXTENSIONS
+    for arg in args:
+        if os.path.isdir(arg):
+            for (root, dirs, files) in os.walk(arg):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in extensions:
+                        yield os.path.join(root, name)
+        elif glob.has_magic(arg):
+            for path in sorted(glob.glob(arg)):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            # 存在しないファイルもそのまま渡してエラーとして記録する
+            yield arg
+
+def load_symbols(path):
+    # [(bbox, Symbol)], .qrファイルならbboxはNone
+    if os.path.splitext(path)[1].lower() in QR_EXTENSIONS:
+        return [(None, qr.load(path))]
+    # 画像を読むときだけnumpy, Imageが必要
+    import scanqr
+    return scanqr.scan_all(scanqr.Image.open(path))
+
+def inspect_symbol(symbol, candidates = 4, inspector = None, hypotheses = 0):
+    # 1つのシンボルの全工程の結果をdictに
+    # hypotheses: 0より大きければ, 復号できなかったときに
+    #             Format Informationの上位hypotheses個の候補を試す
+    if inspector is None:
+        inspector = qr.Inspector(timing=False, affection=False)
+    result = inspector.inspect(symbol)
+    if result.error is not None and hypotheses > 0:
+        (h, tried) = qr.search_hypotheses(symbol, hypotheses)
+        if h is not None:
+            result = inspector.inspect(symbol, (h["ecl"], h["mask"]))
+    record = {}
+    record["version"] = result.version
+    record["ecl"] = qr.ECL_NAMES[result.ecl]
+    record["mask"] = result.mask
+    # [min(距離), 領域1との距離, 領域2との距離, ECL, マスク]
+    record["format_distances"] = [[d, d0, d1, qr.ECL_NAMES[e], m]
+                                  for (d, d0, d1, (e, m))
+                                  in result.formats[:candidates]]
+    if result.versions is not None:
+        record["version_distances"] = [list(v) for v in
+                                       result.versions[:candidates]]
+    if result.error is not None:
+        record["error"] = result.error
+    else:
+        record["text"] = text_to_unicode(result.text)
+    return record
+
+def text_to_unicode(s):
+    # バイトモードの文字列はstrのまま来るのでISO-8859-1(既定)として読む
+    # (漢字モードと混ざったものは既にunicode)
+    if isinstance(s, unicode):
+        return s
+    return s.decode("latin-1")
+
+def inspect_file(args):
+    # ワーカーで実行する (Pool.imap_unorderedから呼べるようにモジュール直下に置く)
+    # 戻り値: 記録(dict)のリスト (どんな例外が起きてもエラーの記録にする)
+    (path, candidates, hypotheses) = args
+    records = []
+    try:
+        symbols = load_symbols(path)
+    except Exception:
+        return [{"file": path, "error": format_exception()}]
+    if not symbols:
+        return [{"file": path, "error": "QR code not found"}]
+    for (index, (bbox, symbol)) in enumerate(symbols):
+        record = {"file": path, "index": index}
+        if bbox is not None:
+            record["bbox"] = [round(b, 1) for b in bbox]
+        try:
+            record.update(inspect_symbol(symbol, candidates,
+                                         hypotheses=hypotheses))
+        except Exception:
+            record["error"] = format_exception()
+        records.append(record)
+    return records
+
+def format_exception():
+    (t, e, tb) = sys.exc_info()
+    return "".join(traceback.format_exception_only(t, e)).strip()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description="Inspect QR code symbols and write JSON Lines.")
+    parser.add_argument("inputs", nargs="+",
+                        help=".qr files, images, directories or globs")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output file (default: stdout)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: CPU count, "
+                             "1: no pool)")
+    parser.add_argument("-k", "--candidates", type=int, default=4,
+                        help="format/version candidates to report")
+    parser.add_argument("--hypotheses", type=int, default=0,
+                        help="on failure, try this many format candidates")
+    parser.add_argument("--maxtasksperchild", type=int, default=100,
+                        help="restart workers after this many inputs")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        out = sys.stdout
+    else:
+        out = open(args.output, "w")
+
+    # 入力はジェネレータのまま渡し, 結果は届いた順に書き出す
+    # (出力の順序は入力と異なることがある. 順序を保つために結果を溜め込まない)
+    jobs = ((path, args.candidates, args.hypotheses)
+            for path in expand_inputs(args.inputs))
+    pool = None
+    if args.jobs == 1:
+        results = itertools.imap(inspect_file, jobs)
+    else:
+        pool = multiprocessing.Pool(args.jobs,
+                                    maxtasksperchild=args.maxtasksperchild)
+        results = pool.imap_unordered(inspect_file, jobs)
+
+    nrecords = 0
+    nerrors = 0
+    try:
+        for records in results:
+            for record in records:
+                try:
+                    line = json.dumps(record, sort_keys=True)
+                except Exception:
+                    record = {"file": record.get("file"),
+                              "index": record.get("index"),
+                              "error": format_exception()}
+                    line = json.dumps(record, sort_keys=True)
+                out.write(line + "\n")
+                nrecords += 1
+                if "error" in record:
+                    nerrors += 1
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if out is not sys.stdout:
+            out.close()
+
+    sys.stderr.write("{} records, {} errors\n".format(nrecords, nerrors))
+    return 1 if nerrors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
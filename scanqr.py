@@ -1,37 +1,342 @@
-import Image
+# -*- coding: utf-8 -*-
+try:
+    from PIL import Image
+except ImportError:
+    import Image
 import sys
+import numpy
+from qr import Symbol
 
-def scan(img, top, left, msize, version):
+def luminance(img):
+    # 画像全体を一度だけ8bitグレースケールの配列(h, w)にする
+    return numpy.asarray(img.convert('L'))
+
+def symbol_from_arrays(dark, known):
+    # dark, known: (size, size)のbool配列
+    def to_int(a):
+        return int((a.astype(numpy.uint8) + ord("0")).tostring(), 2)
+    return Symbol(dark.shape[0], to_int(dark & known), to_int(known))
+
+def sample(img, top, left, msize, version):
+    # 各モジュールの中心の輝度 (size, size) と, 画像内に収まっているか
+    if not isinstance(img, numpy.ndarray):
+        img = luminance(img)
     w = h = version * 4 + 17
-    qr = []
-    for y in range(h):
-        line = []
-        for x in range(w):
-            c = img.getpixel((top + msize * x, left + msize * y))
-            if c == (0, 0, 0):
-                x = 1
-            elif c == (255, 255, 255):
-                x = 0
-            else:
-                x = -1
-            line.append(x)
-        qr.append(line)
-    return qr
-
-version = 7
-
-img = Image.open("version7.png")
-img = img.convert('RGB')
-qr = scan(img, 0, 0, 2, version)
-
-print version * 4 + 17
-for line in qr:
-    for m in line:
-        if m == 1:
-            c = "*"
-        elif m == 0:
-            c = " "
+    ys = numpy.floor(top + msize * (numpy.arange(h) + 0.5)).astype(int)
+    xs = numpy.floor(left + msize * (numpy.arange(w) + 0.5)).astype(int)
+    inside = (((0 <= ys) & (ys < img.shape[0]))[:, None] &
+              ((0 <= xs) & (xs < img.shape[1]))[None, :])
+    ys = ys.clip(0, img.shape[0] - 1)
+    xs = xs.clip(0, img.shape[1] - 1)
+    return (img[ys[:, None], xs[None, :]].astype(int), inside)
+
+def scan(img, top, left, msize, version, threshold = 128, band = 0):
+    # img: Imageかluminanceの配列
+    # top, left: シンボルの左上の位置(y, x), msize: モジュールの大きさ(px)
+    # 各モジュールの中心の輝度がthreshold未満なら1, 以上なら0
+    # ただし|輝度 - threshold| < band のモジュールは未知にする
+    (samples, inside) = sample(img, top, left, msize, version)
+    dark = samples < threshold
+    known = inside & (abs(samples - threshold) >= band)
+    return symbol_from_arrays(dark, known)
+
+def scan_confidence(img, top, left, msize, version, threshold = 128):
+    # scan(band=0)と同じSymbolと, モジュールごとの確からしさ
+    # 確からしさ: |輝度 - threshold| の (size, size) 配列 (画像外は0)
+    # qr.codeword_confidence, qr.erase_weakestに渡して使う
+    (samples, inside) = sample(img, top, left, msize, version)
+    confidence = numpy.where(inside, abs(samples - threshold), 0)
+    return (symbol_from_arrays(samples < threshold, inside), confidence)
+
+def version_candidates(geometry, spread = 1):
+    # versionを前後にずらした (top, left, msize, version) のリスト
+    # ファインダパターンの中心の位置は変えずにmsizeを計算し直す
+    (top, left, msize, version) = geometry
+    cy = top + 3.5 * msize
+    cx = left + 3.5 * msize
+    d = msize * (version * 4 + 10)
+    candidates = [geometry]
+    for k in range(1, spread + 1):
+        for v in [version - k, version + k]:
+            if 1 <= v <= 40:
+                m = d / (v * 4 + 10)
+                candidates.append((cy - 3.5 * m, cx - 3.5 * m, m, v))
+    return candidates
+
+def scan_candidates(img, geometry, spread = 1, threshold = 128, band = 0):
+    # version_candidatesのそれぞれで読み取ったSymbolのリスト
+    # (qr.search_hypothesesに渡す)
+    if not isinstance(img, numpy.ndarray):
+        img = luminance(img)
+    return [scan(img, top, left, msize, version, threshold, band)
+            for (top, left, msize, version)
+            in version_candidates(geometry, spread)]
+
+### Finder Pattern ###
+
+def finder_runs(dark):
+    # 各行で 暗:明:暗:明:暗 = 1:1:3:1:1 となる連を探す
+    # 戻り値: (行, 中心の列, モジュールの大きさ) の配列
+    (h, w) = dark.shape
+    padded = numpy.zeros((h, w + 2), dtype=bool)
+    padded[:, 1:-1] = dark
+    flat = padded.ravel()
+    # 連の開始位置 (行の両端に明を置いているので暗の連は行をまたがない)
+    starts = numpy.nonzero(flat[1:] != flat[:-1])[0] + 1
+    lengths = numpy.diff(starts).astype(float)
+    starts = starts[:-1]
+    n = len(lengths) - 4
+    if n <= 0:
+        return numpy.zeros((0, 3))
+    l = [lengths[k:k + n] for k in range(5)]
+    total = l[0] + l[1] + l[2] + l[3] + l[4]
+    unit = total / 7
+    tolerance = unit / 2
+    ok = flat[starts[:n]] & (total >= 7)
+    for k in [0, 1, 3, 4]:
+        ok &= abs(l[k] - unit) <= tolerance
+    ok &= abs(l[2] - 3 * unit) <= 3 * tolerance
+    # 最初と最後の暗の連が同じ行にあること
+    ends = starts[4:4 + n] + lengths[4:4 + n].astype(int) - 1
+    ok &= starts[:n] // (w + 2) == ends // (w + 2)
+    i = numpy.nonzero(ok)[0]
+    rows = starts[i] // (w + 2)
+    centers = starts[i + 2] % (w + 2) - 1 + l[2][i] / 2
+    return numpy.column_stack([rows + 0.5, centers, unit[i]])
+
+def finder_patterns(lum, threshold = 128):
+    # 縦横両方で1:1:3:1:1が見つかる所をファインダパターンとする
+    # 戻り値: [(中心y, 中心x, モジュールの大きさ, 見つかった連の数)]
+    #         (連の数の多い順)
+    dark = lum < threshold
+    hits = [(y, x, u, 0) for (y, x, u) in finder_runs(dark).tolist()]
+    hits += [(y, x, u, 1) for (x, y, u) in finder_runs(dark.T).tolist()]
+    # [sum y, sum x, sum u, 横の数, 縦の数]
+    clusters = []
+    for (y, x, u, vertical) in hits:
+        for c in clusters:
+            n = c[3] + c[4]
+            (cy, cx, cu) = (c[0] / n, c[1] / n, c[2] / n)
+            if abs(cy - y) <= 2 * cu and abs(cx - x) <= 2 * cu and \
+               abs(cu - u) <= cu / 2:
+                break
         else:
-            c = "?"
-        sys.stdout.write(c)
-    sys.stdout.write("\n")
+            c = [0.0, 0.0, 0.0, 0, 0]
+            clusters.append(c)
+        c[0] += y
+        c[1] += x
+        c[2] += u
+        c[3 + vertical] += 1
+
+    patterns = []
+    for (sy, sx, su, nh, nv) in clusters:
+        if nh == 0 or nv == 0:
+            continue
+        n = nh + nv
+        patterns.append((sy / n, sx / n, su / n, n))
+    patterns.sort(key=lambda p: -p[3])
+    return patterns
+
+def timing_version(line):
+    # タイミングパターンの暗の連の数からversion (数えられなければNone)
+    # 分離パターン(の中心)の間には暗のモジュールが 2 * version + 1 個ある
+    if len(line) == 0:
+        return None
+    runs = int(line[0]) + int((line[1:] & ~line[:-1]).sum())
+    if runs % 2 == 0 or not 1 <= (runs - 1) / 2 <= 40:
+        return None
+    return (runs - 1) / 2
+
+def symbol_geometry(tl, tr, bl, dark = None):
+    # 左上, 右上, 左下のファインダパターンから (top, left, msize, version)
+    # darkがあればタイミングパターンを数えてversionを確かめる
+    unit = (tl[2] + tr[2] + bl[2]) / 3
+    d = ((tr[1] - tl[1]) + (bl[0] - tl[0])) / 2
+    version = int(round((d / unit + 7 - 17) / 4.0))
+    if dark is not None:
+        (h, w) = dark.shape
+        y = int(tl[0] + 3 * unit)
+        x = int(tl[1] + 3 * unit)
+        candidates = []
+        if 0 <= y < h:
+            candidates.append(timing_version(
+                dark[y, max(int(tl[1] + 4 * unit), 0):
+                     max(int(tr[1] - 4 * unit), 0)]))
+        if 0 <= x < w:
+            candidates.append(timing_version(
+                dark[max(int(tl[0] + 4 * unit), 0):
+                     max(int(bl[0] - 4 * unit), 0), x]))
+        candidates = [v for v in candidates
+                      if v is not None and abs(v - version) <= 2]
+        if candidates and candidates.count(candidates[0]) == len(candidates):
+            version = candidates[0]
+    version = min(max(version, 1), 40)
+    msize = d / (version * 4 + 17 - 7)
+    top = (tl[0] + tr[0]) / 2 - 3.5 * msize
+    left = (tl[1] + bl[1]) / 2 - 3.5 * msize
+    return (top, left, msize, version)
+
+def geometry_error(tl, tr, bl):
+    # 軸に沿ったL字からのずれ (モジュール単位)
+    unit = (tl[2] + tr[2] + bl[2]) / 3
+    dx = tr[1] - tl[1]
+    dy = bl[0] - tl[0]
+    if dx <= 7 * unit or dy <= 7 * unit:
+        return None
+    e = abs(tr[0] - tl[0]) + abs(bl[1] - tl[1]) + abs(dx - dy)
+    e += max(tl[2], tr[2], bl[2]) - min(tl[2], tr[2], bl[2])
+    return e / unit
+
+def timing_agreement(dark, geometry):
+    # 標本化したタイミングパターン(6行目, 6列目)が交互になっている割合
+    (top, left, msize, version) = geometry
+    (h, w) = dark.shape
+    size = version * 4 + 17
+    k = numpy.arange(8, size - 8)
+    along = msize * (k + 0.5)
+    across = numpy.zeros(len(k)) + msize * 6.5
+    ys = numpy.concatenate([across, along])
+    xs = numpy.concatenate([along, across])
+    ys = numpy.floor(top + ys).astype(int).clip(0, h - 1)
+    xs = numpy.floor(left + xs).astype(int).clip(0, w - 1)
+    expected = numpy.concatenate([k % 2 == 0, k % 2 == 0])
+    return (dark[ys, xs] == expected).mean()
+
+def find_symbols(patterns, dark = None, tolerance = 2.0, agreement = 0.8):
+    # ファインダパターンの組から, 重ならないシンボルを探す
+    # darkがあればタイミングパターンが合わない組は捨てる
+    # (シンボルが並んでいると隣のシンボルのファインダパターンともL字になる)
+    # 戻り値: [(top, left, msize, version)]
+    triples = []
+    for tl in patterns:
+        # 右上は右にほぼ水平, 左下は下にほぼ垂直にあるものだけを組にする
+        slack = tolerance * tl[2]
+        right = [p for p in patterns
+                 if p[1] > tl[1] and abs(p[0] - tl[0]) <= slack]
+        below = [p for p in patterns
+                 if p[0] > tl[0] and abs(p[1] - tl[1]) <= slack]
+        for tr in right:
+            for bl in below:
+                e = geometry_error(tl, tr, bl)
+                if e is None or e > tolerance:
+                    continue
+                geometry = symbol_geometry(tl, tr, bl, dark)
+                if dark is not None and \
+                   timing_agreement(dark, geometry) < agreement:
+                    continue
+                triples.append((e, tl, tr, bl, geometry))
+    triples.sort(key=lambda t: t[0])
+    used = set()
+    symbols = []
+    for (e, tl, tr, bl, geometry) in triples:
+        if id(tl) in used or id(tr) in used or id(bl) in used:
+            continue
+        used.update([id(tl), id(tr), id(bl)])
+        symbols.append(geometry)
+    return symbols
+
+def locate(img, threshold = 128):
+    # シンボルを1つ探して (top, left, msize, version), 見つからなければNone
+    if not isinstance(img, numpy.ndarray):
+        img = luminance(img)
+    symbols = find_symbols(finder_patterns(img, threshold), img < threshold)
+    if not symbols:
+        return None
+    return symbols[0]
+
+def locate_and_scan(img, threshold = 128, band = 0):
+    if not isinstance(img, numpy.ndarray):
+        img = luminance(img)
+    geometry = locate(img, threshold)
+    if geometry is None:
+        return None
+    (top, left, msize, version) = geometry
+    return scan(img, top, left, msize, version, threshold, band)
+
+### Tiled Scanning ###
+
+def tiles(shape, tile = 1024, overlap = 256):
+    # 画像を重なりのあるタイルに分ける: [(top, left, bottom, right)]
+    # overlapより小さいファインダパターンはどれかのタイルに丸ごと入る
+    (h, w) = shape
+    step = max(tile - overlap, 1)
+    def starts(n):
+        if n <= tile:
+            return [0]
+        s = range(0, n - tile, step)
+        return s + [n - tile]
+    return [(y, x, min(y + tile, h), min(x + tile, w))
+            for y in starts(h) for x in starts(w)]
+
+def symbol_bbox(geometry):
+    # (top, left, bottom, right)
+    (top, left, msize, version) = geometry
+    size = msize * (version * 4 + 17)
+    return (top, left, top + size, left + size)
+
+def tile_patterns(args):
+    # scan_allの下請け (executorから呼べるようにモジュール直下に置く)
+    # タイルのファインダパターンを画像全体の座標で返す
+    (lum, top, left, threshold) = args
+    return [(y + top, x + left, u, n)
+            for (y, x, u, n) in finder_patterns(lum, threshold)]
+
+def merge_patterns(patterns):
+    # タイルの重なりで重複して見つかったファインダパターンを1つにまとめる
+    # 連の数の多い方(タイルの端で欠けていない方)を残す
+    merged = []
+    for p in sorted(patterns, key=lambda p: -p[3]):
+        for q in merged:
+            if abs(q[0] - p[0]) <= 2 * q[2] and abs(q[1] - p[1]) <= 2 * q[2] \
+               and abs(q[2] - p[2]) <= q[2] / 2:
+                break
+        else:
+            merged.append(p)
+    return merged
+
+def scan_all(img, threshold = 128, band = 0, tile = 1024, overlap = 256,
+             executor = None):
+    # 大きな画像から全てのシンボルを探して [(bbox, Symbol)] を返す
+    # bbox: (top, left, bottom, right), 上から順に並べる
+    # executor: concurrent.futures.ProcessPoolExecutor等 (mapを持つもの)
+    # ファインダパターンの検出だけをタイルごとに行い, 組にするのと
+    # 標本化は画像全体で行う (タイルの境界をまたぐ大きなシンボルも見つかる)
+    if not isinstance(img, numpy.ndarray):
+        img = luminance(img)
+    jobs = [(img[t:b, l:r], t, l, threshold)
+            for (t, l, b, r) in tiles(img.shape, tile, overlap)]
+    if executor is None:
+        results = map(tile_patterns, jobs)
+    else:
+        results = executor.map(tile_patterns, jobs)
+    patterns = merge_patterns([p for found in results for p in found])
+    symbols = []
+    for geometry in find_symbols(patterns, img < threshold):
+        (top, left, msize, version) = geometry
+        qr = scan(img, top, left, msize, version, threshold, band)
+        symbols.append((symbol_bbox(geometry), qr))
+    symbols.sort(key=lambda s: (s[0][0], s[0][1]))
+    return symbols
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = "version7.png"
+
+    img = Image.open(filename)
+    qr = locate_and_scan(img)
+    if qr is None:
+        sys.exit("QR code not found")
+
+    print len(qr)
+    for line in qr.rows():
+        for m in line:
+            if m == 1:
+                c = "*"
+            elif m == 0:
+                c = " "
+            else:
+                c = "?"
+            sys.stdout.write(c)
+        sys.stdout.write("\n")